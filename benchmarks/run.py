@@ -0,0 +1,39 @@
+"""Run the fc-nmap benchmarks and keep the results next to this script.
+
+    python benchmarks/run.py [SIZES]
+
+SIZES is a comma separated list of topology sizes (default 100,1000,10000).
+Results go to benchmarks/results/<version>-<timestamp>.json and are compared
+with the most recent earlier file there; the script exits with 1 if any
+rate dropped by more than 20%.
+"""
+import glob
+import json
+import os
+import sys
+
+from fc_nmap import bench
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+def main(sizes='100,1000,10000'):
+    report = bench.run([int(s) for s in sizes.split(',')])
+    previous = sorted(glob.glob(os.path.join(RESULTS, '*.json')), key=os.path.getmtime)
+    os.makedirs(RESULTS, exist_ok=True)
+    path = os.path.join(RESULTS, f"{report['version']}-{report['timestamp']}.json")
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+        f.write('\n')
+    print(f'Results saved to {path}')
+    for r in report['results']:
+        print(f"{r['name']:<24} {r['size']:>6} {r['rate']:>12} {r['unit']}")
+    if previous:
+        with open(previous[-1]) as f:
+            regressions = bench.compare(report, json.load(f))
+        for r, before in regressions:
+            print(f"REGRESSION {r['name']} size={r['size']}: {r['rate']} {r['unit']} (was {before})")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv[1:]))
@@ -1,3 +1,10 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import click
 import grpc
 from . fcproto import rpc_pb2, rpc_pb2_grpc
 
@@ -6,27 +13,189 @@ from . fcproto.request_response_pb2 import (
     HubInfoResponse, HubInfoRequest, FidRequest, MessagesResponse,
     )
 
+# PEM root certificates trusted by TLS channels, None for the system defaults.
+# _FROM_ENV reads them from the file named by FCNMAP_SSL_ROOTS, if set, when the
+# first TLS channel opens, so a stale path only fails commands that use TLS.
+_FROM_ENV = object()
+_root_certificates = _FROM_ENV
+_env_roots = {}  # FCNMAP_SSL_ROOTS path -> its contents
+
+def set_root_certificates(pem):
+    """Trust `pem` (bytes) instead of the system roots, e.g. for a local simulator.
+
+    Returns the previous value, to pass back here to restore it.
+    """
+    global _root_certificates
+    previous, _root_certificates = _root_certificates, pem
+    return previous
+
+def root_certificates():
+    """The PEM root certificates TLS channels trust, None for the system defaults."""
+    if _root_certificates is not _FROM_ENV:
+        return _root_certificates
+    path = os.environ.get('FCNMAP_SSL_ROOTS')
+    if not path:
+        return None
+    if path not in _env_roots:
+        try:
+            with open(path, 'rb') as f:
+                _env_roots[path] = f.read()
+        except OSError as e:
+            raise click.FileError(path, hint=f'FCNMAP_SSL_ROOTS: {e.strerror}')
+    return _env_roots[path]
+
+def _open_channel(address, use_async=False, use_ssl=False):
+    if use_async:
+        if use_ssl:
+            return grpc.aio.secure_channel(address, grpc.ssl_channel_credentials(root_certificates()))
+        return grpc.aio.insecure_channel(address)
+    if use_ssl:
+        return grpc.secure_channel(address, grpc.ssl_channel_credentials(root_certificates()))
+    return grpc.insecure_channel(address)
+
+class ChannelPool:
+    """Open gRPC channels, reused by every HubService talking to the same hub.
+
+    Channels are keyed by (address, use_ssl). get() checks a channel out
+    and release() gives it back once the call on it is over. An idle
+    channel that has not been used for `ttl` seconds is closed, and when
+    more than `max_size` channels are open the least recently used idle
+    ones are closed. Channels with calls in flight are never closed, so
+    the pool can hold more than `max_size` while they last.
+    A pool of grpc.aio channels is bound to the event loop that uses it and
+    must be closed with `aclose()` before that loop ends.
+    """
+    def __init__(self, max_size=256, ttl=60, use_async=False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.use_async = use_async
+        self._channels = OrderedDict()  # (address, use_ssl) -> [channel, last_used, checkouts], least recent first
+        self._closing = []
+        self._lock = threading.Lock()
+
+    def get(self, address, use_ssl=False):
+        """Check out the channel to `address`, opening it if needed. Give it back with release()."""
+        key = (address, use_ssl)
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            entry = self._channels.pop(key, None) or [_open_channel(address, self.use_async, use_ssl), now, 0]
+            entry[1] = now
+            entry[2] += 1
+            self._channels[key] = entry
+            self._evict(now)
+        return entry[0]
+
+    def release(self, address, use_ssl=False):
+        """Give back a channel from get(); once no call holds it, it can be closed."""
+        key = (address, use_ssl)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._channels.get(key)
+            if entry is None:
+                # The pool was closed in the meantime.
+                return
+            entry[1] = now
+            entry[2] -= 1
+            self._channels.move_to_end(key)
+            self._evict(now)
+
+    def __len__(self):
+        return len(self._channels)
+
+    def _evict(self, now):
+        excess = len(self._channels) - self.max_size
+        for key, (channel, last_used, checkouts) in list(self._channels.items()):
+            if checkouts:
+                continue
+            if excess <= 0 and now - last_used <= self.ttl:
+                # Every idle channel after this one was used more recently.
+                break
+            del self._channels[key]
+            self._close(channel)
+            excess -= 1
+
+    def _close(self, channel):
+        if self.use_async:
+            self._closing.append(asyncio.ensure_future(channel.close()))
+        else:
+            channel.close()
+
+    def close(self):
+        with self._lock:
+            while self._channels:
+                _, (channel, _, _) = self._channels.popitem()
+                self._close(channel)
+
+    async def aclose(self):
+        self.close()
+        closing, self._closing = self._closing, []
+        await asyncio.gather(*closing)
+
+# Process-wide pool used by every synchronous HubService.
+channel_pool = ChannelPool()
+
+# Active cassette.Cassette, see use_cassette(). None means talk to the network.
+_cassette = None
+
+def use_cassette(cassette):
+    """Record every HubService call to `cassette`, or answer them from it. Returns the previous one."""
+    global _cassette
+    previous, _cassette = _cassette, cassette
+    return previous
+
+def replaying():
+    """True while HubService calls are answered from a cassette instead of the network."""
+    return _cassette is not None and _cassette.replaying
+
 class HubService:
-    def __init__(self, address, use_async=False, use_ssl=False, timeout=10):
+    def __init__(self, address, use_async=False, use_ssl=False, timeout=10, pool=None):
         self._async = use_async        
-        if use_async:
-            if use_ssl:
-                self._channel = grpc.aio.secure_channel(address, grpc.ssl_channel_credentials())
-            else:
-                self._channel = grpc.aio.insecure_channel(address)
+        self.address = address
+        self.use_ssl = use_ssl
+        self._pool = pool if pool is not None or use_async else channel_pool
+        self._channel = None
+        self.stub = None
+        if _cassette is not None and _cassette.replaying:
+            return
+        if self._pool is not None:
+            self._channel = self._pool.get(address, use_ssl)
         else:
-            if use_ssl:
-                self._channel = grpc.secure_channel(address, grpc.ssl_channel_credentials())
-            else:
-                self._channel = grpc.insecure_channel(address)
+            self._channel = _open_channel(address, use_async, use_ssl)
         # grpc.channel_ready_future(self._channel).result(timeout=timeout)
-        self._stub = rpc_pb2_grpc.HubServiceStub(self._channel)
+        self.stub = rpc_pb2_grpc.HubServiceStub(self._channel)
+
+    @property
+    def use_async(self):
+        return self._async
+
     def close(self):
-        self._channel.close()
+        """Call once the calls made through this service are over."""
+        (channel, self._channel) = (self._channel, None)
+        if channel is None:
+            return
+        if self._pool is not None:
+            # Pooled channels stay open for the next caller.
+            self._pool.release(self.address, self.use_ssl)
+            return
+        # For grpc.aio channels this returns a coroutine the caller must await.
+        return channel.close()
     
     def GetInfo(self, db_stats=False, timeout=10) -> HubInfoResponse:
-        return self._stub.GetInfo(HubInfoRequest(db_stats=db_stats), timeout=timeout)
+        request = HubInfoRequest(db_stats=db_stats)
+        if _cassette is not None:
+            return _cassette.call(self, 'GetInfo', request, timeout, HubInfoResponse)
+        return self.stub.GetInfo(request, timeout=timeout)
+
+    def GetInfoFuture(self, db_stats=False, timeout=10):
+        """Start GetInfo without waiting, returns a grpc.Future that can be cancelled."""
+        request = HubInfoRequest(db_stats=db_stats)
+        if _cassette is not None:
+            return _cassette.future(self, 'GetInfo', request, timeout, HubInfoResponse)
+        return self.stub.GetInfo.future(request, timeout=timeout)
 
     #  rpc GetCurrentPeers(Empty) returns (ContactInfoResponse);
-    def GetCurrentPeers(self) -> ContactInfoResponse:
-        return self._stub.GetCurrentPeers(Empty())
+    def GetCurrentPeers(self, timeout=None) -> ContactInfoResponse:
+        if _cassette is not None:
+            return _cassette.call(self, 'GetCurrentPeers', Empty(), timeout, ContactInfoResponse)
+        return self.stub.GetCurrentPeers(Empty(), timeout=timeout)
@@ -0,0 +1,125 @@
+"""Archive of raw GetCurrentPeers responses, for re-ingesting without crawling again.
+
+A scan with an archive writes every peer list it receives, untouched, to
+gzip-compressed segment files named `<scan_id>-<n>.seg.gz`. A segment is
+MAGIC, the length-prefixed scan id, and then one record per response:
+
+    observer length (u32), response length (u32), received at (u64, ms)
+    observer address (utf-8), serialized ContactInfoResponse
+
+all little-endian. Segments are independent, so ingest() parses them in
+parallel, one process per segment.
+"""
+import gzip
+import os
+import struct
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from . fcproto.request_response_pb2 import ContactInfoResponse
+from . get_hubs import _merge_peers
+
+MAGIC = b'FCNMAPA1'
+RECORD = struct.Struct('<IIQ')
+SCAN_ID = struct.Struct('<H')
+
+# Responses per segment file before a new one is started.
+SEGMENT_RECORDS = 500
+
+def new_scan_id():
+    return time.strftime('%Y%m%dT%H%M%S')
+
+class ArchiveWriter:
+    """Append peer lists to segment files in `directory`. Pass `add` as a crawl's on_peers."""
+    def __init__(self, directory, scan_id=None, segment_records=SEGMENT_RECORDS):
+        self.directory = directory
+        self.scan_id = scan_id or new_scan_id()
+        self.segment_records = segment_records
+        self.records = 0
+        self.paths = []
+        self._file = None
+        self._segment_count = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _open_segment(self):
+        path = os.path.join(self.directory, f'{self.scan_id}-{len(self.paths):05d}.seg.gz')
+        self._file = gzip.open(path, 'wb')
+        scan_id = self.scan_id.encode()
+        self._file.write(MAGIC + SCAN_ID.pack(len(scan_id)) + scan_id)
+        self._segment_count = 0
+        self.paths.append(path)
+
+    def add(self, observer, response):
+        observer = observer.encode()
+        payload = response.SerializeToString()
+        with self._lock:
+            if self._file is None or self._segment_count >= self.segment_records:
+                self.close()
+                self._open_segment()
+            self._file.write(RECORD.pack(len(observer), len(payload), int(time.time() * 1000)) + observer + payload)
+            self._segment_count += 1
+            self.records += 1
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+def read_segment(path):
+    """Yield (scan_id, observer, received_at ms, ContactInfoResponse) for every record in a segment."""
+    with gzip.open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not an fc-nmap archive segment')
+        (length,) = SCAN_ID.unpack(f.read(SCAN_ID.size))
+        scan_id = f.read(length).decode()
+        while header := f.read(RECORD.size):
+            if len(header) < RECORD.size:
+                raise ValueError(f'{path} is truncated')
+            (observer_length, payload_length, received_at) = RECORD.unpack(header)
+            observer = f.read(observer_length).decode()
+            payload = f.read(payload_length)
+            if len(payload) < payload_length:
+                raise ValueError(f'{path} is truncated')
+            yield (scan_id, observer, received_at, ContactInfoResponse.FromString(payload))
+
+def segments(paths):
+    """Segment files in `paths`, expanding directories."""
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found.extend(sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.seg.gz')))
+        else:
+            found.append(path)
+    return found
+
+def _ingest_segment(path):
+    hubs = {}
+    responses = 0
+    for (_, _, _, peers) in read_segment(path):
+        _merge_peers(peers, hubs)
+        responses += 1
+    return (hubs, responses)
+
+def ingest(paths, processes=None):
+    """Merge every archived peer list into one hubs dict, like a scan would.
+
+    Segments are parsed by a pool of `processes` processes (one per CPU by
+    default). Returns (hubs, number of responses).
+    """
+    hubs = {}
+    responses = 0
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for (segment_hubs, n) in pool.map(_ingest_segment, segments(paths)):
+            responses += n
+            for id, hub in segment_hubs.items():
+                if id not in hubs or hubs[id]['timestamp'] < hub['timestamp']:
+                    hubs[id] = hub
+    return (hubs, responses)
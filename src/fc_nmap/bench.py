@@ -0,0 +1,134 @@
+"""Throughput benchmarks for the crawler, the prober and the exports.
+
+Everything runs offline against fc_nmap.simulator and a synthetic hubs.db,
+so results are comparable between runs and releases. Each benchmark
+returns {'name', 'size', 'seconds', 'rate', 'unit'} dicts.
+"""
+import asyncio
+import contextlib
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from grpc import StatusCode
+
+from fc_nmap import db, dbexports
+from fc_nmap.__about__ import __version__
+from fc_nmap.get_hubs import get_hubs_bfs, get_hubs_concurrent
+from fc_nmap.schema import RPC_METHODS, intern_hubs, pack_ip
+from fc_nmap.simulator import HubSimulator, Topology
+
+EXPORTS = [
+    dbexports.export_full,
+    dbexports.export_countries,
+    dbexports.export_asn,
+    dbexports.export_fids,
+    dbexports.export_app_version,
+    dbexports.export_latlong,
+    dbexports.export_latency,
+]
+
+COUNTRIES = [('US', 'United States of America'), ('DE', 'Germany'), ('FI', 'Finland'), ('SG', 'Singapore'), ('JP', 'Japan')]
+ASNS = [(16509, 'Amazon.com Inc.'), (24940, 'Hetzner Online GmbH'), (14061, 'DigitalOcean LLC'), (51167, 'Contabo GmbH')]
+
+def _result(name, size, seconds, count, unit):
+    return {'name': name, 'size': size, 'seconds': round(seconds, 4), 'rate': round(count / seconds, 2), 'unit': unit}
+
+def _topology(size, seed):
+    return Topology(size, degree=8, dead=0.05, seed=seed)
+
+def bench_scan(size, concurrency=32, seed=1):
+    """Hubs discovered per second by the sequential and the concurrent BFS crawl."""
+    results = []
+    with HubSimulator(_topology(size, seed)) as simulator:
+        started = time.perf_counter()
+        hubs = get_hubs_bfs(simulator.address(), {}, size * 2, timeout=2)
+        results.append(_result('scan-bfs', size, time.perf_counter() - started, len(hubs), 'hubs/s'))
+        started = time.perf_counter()
+        hubs = asyncio.run(get_hubs_concurrent(simulator.address(), {}, size * 2, concurrency=concurrency, timeout=2, mode='bfs'))
+        results.append(_result(f'scan-concurrent-{concurrency}', size, time.perf_counter() - started, len(hubs), 'hubs/s'))
+    return results
+
+def bench_probe(size, workers=16, seed=1):
+    """GetInfo probes per second through update_hub_info."""
+    from fc_nmap.cli import update_hub_info
+    with HubSimulator(_topology(size, seed)) as simulator, tempfile.TemporaryDirectory() as tmp:
+        dbpath = os.path.join(tmp, 'hubs.db')
+        conn = db.connect(dbpath)
+        ids = intern_hubs(conn, [f'{simulator.host}:{h.port}' for h in simulator.topology.hubs])
+        conn.executemany("""
+            UPDATE hub SET dnsname = '', proto_version = '2024.9.4', app_version = '1.15.6', ts = unixepoch() WHERE hub_id = ?
+            """, [(hub_id,) for hub_id in ids.values()])
+        conn.execute("""INSERT OR REPLACE INTO kv VALUES ('LAST_SCAN', unixepoch('now'))""")
+        conn.commit()
+        conn.close()
+        started = time.perf_counter()
+        # Keep the progress bar off stdout, where the JSON results may go.
+        with contextlib.redirect_stdout(sys.stderr):
+            update_hub_info(None, 86400, 2, workers=workers, allow_private=True, dbpath=dbpath)
+        return [_result(f'probe-{workers}', size, time.perf_counter() - started, size, 'probes/s')]
+
+def populate_db(dbpath, size, seed=1):
+    """Fill a new hubs.db with `size` recently seen hubs, their info, location and RPC log."""
+    rnd = random.Random(seed)
+    conn = db.connect(dbpath)
+    hubs = [(f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}', 2283) for i in range(size)]
+    # Hub i gets addr_id and hub_id i + 1.
+    conn.executemany("""
+        INSERT INTO addr (addr_id, ip, country_code, country_name, latitude, longitude, as_number, as_name, updated_at) VALUES (?,?,?,?,?,?,?,?,unixepoch())
+        """, [(i + 1, pack_ip(ip), *rnd.choice(COUNTRIES), round(rnd.uniform(-60, 60), 1), round(rnd.uniform(-180, 180), 1), *rnd.choice(ASNS)) for i, (ip, _) in enumerate(hubs)])
+    conn.executemany("""
+        INSERT INTO hub (hub_id, addr_id, port, dnsname, proto_version, app_version, ts) VALUES (?,?,?,'','2024.9.4',?,unixepoch())
+        """, [(i + 1, i + 1, port, rnd.choice(['1.15.5', '1.15.6', '1.16.0'])) for i, (_, port) in enumerate(hubs)])
+    conn.executemany("""
+        INSERT INTO hub_info (hub_id, version, is_syncing, nickname, fid, num_messages, updated_at) VALUES (?,'1.15.6',0,'',?,?,unixepoch())
+        """, [(i + 1, rnd.randrange(1, size // 4 + 2), rnd.randrange(10**8)) for i in range(size)])
+    conn.executemany("""
+        INSERT INTO rpc_log (ts, hub_id, method, tls, status, ms, size) VALUES (unixepoch(),?,?,0,?,?,100)
+        """, [(i + 1, RPC_METHODS['GetInfo'], rnd.choice([StatusCode.OK, StatusCode.OK, StatusCode.OK, StatusCode.UNAVAILABLE]).value[0], rnd.randrange(5, 2000)) for i in range(size) for _ in range(5)])
+    conn.commit()
+    conn.close()
+
+def bench_exports(size, seed=1):
+    """Hub rows per second read by each dbexports report."""
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        dbpath = os.path.join(tmp, 'hubs.db')
+        populate_db(dbpath, size, seed)
+        for export in EXPORTS:
+            started = time.perf_counter()
+            export(dbpath=dbpath, out=os.devnull)
+            results.append(_result(export.__name__, size, time.perf_counter() - started, size, 'hubs/s'))
+    return results
+
+BENCHMARKS = {
+    'scan': bench_scan,
+    'probe': bench_probe,
+    'export': bench_exports,
+}
+
+def run(sizes, names=None):
+    """Run the benchmarks in `names` (all by default) for every size."""
+    results = []
+    for name in names or BENCHMARKS:
+        for size in sizes:
+            results.extend(BENCHMARKS[name](size))
+    return {
+        'version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': int(time.time()),
+        'results': results,
+    }
+
+def compare(report, baseline, tolerance=0.2):
+    """Results whose rate dropped more than `tolerance` below the baseline, as (result, baseline rate)."""
+    before = {(r['name'], r['size']): r['rate'] for r in baseline['results']}
+    return [
+        (r, before[(r['name'], r['size'])])
+        for r in report['results']
+        if (r['name'], r['size']) in before and r['rate'] < before[(r['name'], r['size'])] * (1 - tolerance)
+    ]
@@ -0,0 +1,170 @@
+"""Record gRPC responses to a file and play them back without the network.
+
+A cassette is a JSON lines file, one line per call: method, address,
+transport, duration, status code and the serialized response. While a
+cassette is active (GrpcClient.use_cassette), every HubService call is
+either recorded to it or answered from it.
+"""
+import asyncio
+import base64
+import json
+import threading
+import time
+
+from grpc import RpcError, StatusCode
+
+class ReplayedRpcError(RpcError):
+    """A recorded gRPC error, raised again on replay."""
+    def __init__(self, code, details=''):
+        self._code = code
+        self._details = details
+
+    def code(self):
+        return self._code
+
+    def details(self):
+        return self._details
+
+class _ReplayedCall:
+    """Stands in for the grpc.Future returned by HubService.GetInfoFuture."""
+    def __init__(self, response, error, delay=0):
+        self._response = response
+        self._error = error
+        self._delay = delay
+        self._cancelled = False
+
+    def add_done_callback(self, fn):
+        if self._delay:
+            threading.Timer(self._delay, fn, (self,)).start()
+        else:
+            fn(self)
+
+    def cancel(self):
+        self._cancelled = True
+        return True
+
+    def cancelled(self):
+        return self._cancelled
+
+    def code(self):
+        if self._cancelled:
+            return StatusCode.CANCELLED
+        return self._error.code() if self._error else StatusCode.OK
+
+    def exception(self):
+        return self._error
+
+    def result(self):
+        if self._error:
+            raise self._error
+        return self._response
+
+class Cassette:
+    """Record to or replay from `path`; `mode` is 'record' or 'replay'.
+
+    Replayed calls are matched on (method, address, use_ssl), in recorded
+    order; once a call's recordings run out the last one is repeated.
+    Calls that were never recorded fail with UNAVAILABLE. With `timing`,
+    replayed calls take as long as the recorded ones did.
+    """
+    def __init__(self, path, mode='replay', timing=False):
+        self.path = path
+        self.mode = mode
+        self.timing = timing
+        self._lock = threading.Lock()
+        self._recordings = {}
+        if mode == 'record':
+            self._file = open(path, 'w')
+        else:
+            self._file = None
+            with open(path) as f:
+                for line in f:
+                    r = json.loads(line)
+                    self._recordings.setdefault((r['method'], r['address'], r['tls']), []).append(r)
+
+    @property
+    def replaying(self):
+        return self.mode == 'replay'
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def _write(self, service, method, seconds, code, details='', response=None):
+        line = json.dumps({
+            'method': method,
+            'address': service.address,
+            'tls': service.use_ssl,
+            'ms': round(seconds * 1000, 3),
+            'status': code.name,
+            'details': details,
+            'response': base64.b64encode(response.SerializeToString()).decode() if response is not None else None,
+        })
+        with self._lock:
+            # A call that ends after close(), like a cancelled race loser, is not recorded.
+            if self._file:
+                self._file.write(line + '\n')
+
+    def _next(self, service, method, response_type):
+        """(response, error, seconds) for the next replayed call."""
+        with self._lock:
+            recordings = self._recordings.get((method, service.address, service.use_ssl))
+            if not recordings:
+                return (None, ReplayedRpcError(StatusCode.UNAVAILABLE, 'not in cassette'), 0)
+            r = recordings.pop(0) if len(recordings) > 1 else recordings[0]
+        seconds = r['ms'] / 1000 if self.timing else 0
+        if r['status'] != 'OK':
+            return (None, ReplayedRpcError(StatusCode[r['status']], r['details']), seconds)
+        return (response_type.FromString(base64.b64decode(r['response'])), None, seconds)
+
+    def call(self, service, method, request, timeout, response_type):
+        """Make (or replay) a unary call; a coroutine for grpc.aio services."""
+        if service.use_async:
+            return self._acall(service, method, request, timeout, response_type)
+        if self.replaying:
+            (response, error, seconds) = self._next(service, method, response_type)
+            if seconds:
+                time.sleep(seconds)
+            if error:
+                raise error
+            return response
+        started = time.monotonic()
+        try:
+            response = getattr(service.stub, method)(request, timeout=timeout)
+        except RpcError as e:
+            self._write(service, method, time.monotonic() - started, e.code(), e.details())
+            raise
+        self._write(service, method, time.monotonic() - started, StatusCode.OK, response=response)
+        return response
+
+    async def _acall(self, service, method, request, timeout, response_type):
+        if self.replaying:
+            (response, error, seconds) = self._next(service, method, response_type)
+            if seconds:
+                await asyncio.sleep(seconds)
+            if error:
+                raise error
+            return response
+        started = time.monotonic()
+        try:
+            response = await getattr(service.stub, method)(request, timeout=timeout)
+        except RpcError as e:
+            self._write(service, method, time.monotonic() - started, e.code(), e.details())
+            raise
+        self._write(service, method, time.monotonic() - started, StatusCode.OK, response=response)
+        return response
+
+    def future(self, service, method, request, timeout, response_type):
+        """Like call(), for the grpc.Future flavour of a unary call."""
+        if self.replaying:
+            return _ReplayedCall(*self._next(service, method, response_type))
+        started = time.monotonic()
+        call = getattr(service.stub, method).future(request, timeout=timeout)
+        def done(call):
+            code = call.code()
+            self._write(service, method, time.monotonic() - started, code, call.details() or '',
+                call.result() if code == StatusCode.OK else None)
+        call.add_done_callback(done)
+        return call
@@ -1,40 +1,112 @@
 # SPDX-FileCopyrightText: 2024-present Panayotis Vryonis <vrypan@gmail.comm>
 #
 # SPDX-License-Identifier: MIT
+import asyncio
 import click
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 import random
-import sqlite3
 import sys
+import time
 
 from fc_nmap.__about__ import __version__
-from fc_nmap.get_hubs import get_hub_info, get_hubs
-from fc_nmap import dbexports, dbexports_maps
-from fc_nmap.ip2location import resolve_ip
+from fc_nmap.archive import ArchiveWriter, ingest
+from fc_nmap.cassette import Cassette
+from fc_nmap.GrpcClient import replaying, use_cassette
+from fc_nmap.graph import EdgeRecorder, articulation_points, connected_components, degree_distribution, load_graph
+from fc_nmap.get_hubs import DiscoveryWindow, _merge_peers, get_hub_info, get_hubs, get_hubs_bfs, get_hubs_concurrent, pick_random_hub
+from fc_nmap.hubstate import HubState
+from fc_nmap.schema import SCHEMA_VERSION, create_schema, migrate as migrate_schema, pack_ip, pending_migrations, schema_version, unpack_ip
+from fc_nmap.simulator import HubSimulator, Topology
+from fc_nmap import bench as benchmarks, db, dbexports, dbexports_maps, geodb, ip2location
 
 @click.group(context_settings={"help_option_names": ["-h", "--help"]}, invoke_without_command=True)
 @click.version_option(version=__version__, prog_name="fc-nmap")
-def fc_nmap():
+@click.option('--db', 'dbpath', default=db.DEFAULT_PATH, envvar='FCNMAP_DB', help='SQLite database to use.', show_default=True)
+def fc_nmap(dbpath):
     """Farcaster Network Mapper
     """
-    pass
+    db.set_path(dbpath)
+
+def _use_cassette(record, replay, replay_timing):
+    """Route hub calls through the --record or --replay cassette, if any, until the command ends."""
+    if record and replay:
+        raise click.UsageError('--record and --replay cannot be used together.')
+    if record:
+        cassette = Cassette(record, 'record')
+    elif replay:
+        cassette = Cassette(replay, 'replay', timing=replay_timing)
+    else:
+        return
+    previous = use_cassette(cassette)
+    def close():
+        use_cassette(previous)
+        cassette.close()
+    click.get_current_context().call_on_close(close)
+
+def _hub_state(conn):
+    """The HubState kept in `conn`, or an empty one while replaying a cassette.
+
+    Replayed calls take no time and must not reach rpc_log or the latency
+    history, and must not be skipped by the live circuit breaker, so the
+    replay state is never loaded or saved.
+    """
+    return HubState() if replaying() else HubState(conn)
+
+def _save_hub_state(writer, state):
+    if not replaying():
+        writer.call(state.save)
+
+# Default --min-discovery-rate for random scans.
+MIN_DISCOVERY_RATE = 0.5
 
 @fc_nmap.command()
 @click.option('--hub', default='hoyt.farcaster.xyz:2283', help='IP:port of hub to start crawling from.')
-@click.option('--hops', default=10, help='Number of hubs to query.')
+@click.option('--hops', default=10, help='Maximum number of hubs to query.')
+@click.option('--converge-window', default=10, help='Number of recent peer lists used to measure the discovery rate.', show_default=True)
+@click.option('--min-discovery-rate', type=float, help='Stop once the recent peer lists add fewer new hubs than this, on average. 0 disables.  [default: 0.5 in random mode, 0 in bfs mode]')
+@click.option('--mode', default='random', type=click.Choice(['random', 'bfs'], case_sensitive=False), help='random: query --hops hubs picked at random. bfs: query every discovered hub once, up to --hops hubs.', show_default=True)
+@click.option('--concurrency', default=1, help='Number of GetCurrentPeers calls to keep in flight.', show_default=True)
+@click.option('--timeout', default=5, help='Seconds to wait before gRPC timeout, for hubs without latency history.', show_default=True)
 @click.option('--keep-stats', is_flag=True, help="Store scan stats in db.", envvar='FCNMAP_KEEP_STATS')
+@click.option('--record', type=click.Path(dir_okay=False, writable=True), help='Save every hub response, its timing and errors to this cassette file.')
+@click.option('--replay', type=click.Path(exists=True, dir_okay=False), help='Answer hub calls from this cassette file instead of the network.')
+@click.option('--replay-timing', is_flag=True, help='With --replay, make each call take as long as it did when recorded.')
+@click.option('--archive', type=click.Path(file_okay=False, writable=True), help='Also save every raw peer list to compressed segment files in this directory (see ingest-archive).')
 # @click.option('--out', default='-', type=click.File('w'), help="Output file, leave empty for stdout")
-def scan(hub, hops, keep_stats):
+def scan(hub, hops, converge_window, min_discovery_rate, mode, concurrency, timeout, keep_stats, record, replay, replay_timing, archive):
     """Scan the network
     """
+    if replay and mode == 'random':
+        raise click.UsageError('--replay needs --mode bfs: a random scan picks other hubs than the recorded one.')
+    _use_cassette(record, replay, replay_timing)
     try:
-        db_conn = sqlite3.connect('hubs.db')
-        db_cursor = db_conn.cursor()
+        db_conn = db.connect()
     except:
-        click.echo('hubs.db not found. Run "fc-nmap initdb" to create it.')
+        click.echo(f'{db.path()} not found. Run "fc-nmap initdb" to create it.')
         sys.exit(1)
     hubs = {}
-    with click.progressbar(
+    stats = {}
+    if min_discovery_rate is None:
+        # A BFS crawl runs until its frontier is empty, unless asked to stop early.
+        min_discovery_rate = MIN_DISCOVERY_RATE if mode == 'random' else 0
+    window = DiscoveryWindow(converge_window, min_discovery_rate) if min_discovery_rate > 0 else None
+    state = _hub_state(db_conn)
+    db_conn.close()
+    archive = ArchiveWriter(archive) if archive else None
+    edges = EdgeRecorder()
+    # Hubs are written as their peer lists arrive; on Ctrl-C the writer still commits what it was given.
+    writer = db.DbWriter()
+    def on_peers(address, peers):
+        edges.add(address, peers)
+        received = {}
+        _merge_peers(peers, received)
+        _save_hubs(writer, received)
+        if archive:
+            archive.add(address, peers)
+    with writer, click.progressbar(
             length=hops, 
             label='Scanning', 
             width=0,
@@ -44,59 +116,129 @@ def scan(hub, hops, keep_stats):
             fill_char='#',
             item_show_func=lambda a: a.rjust(21) if a else None
         ) as bar:
-        bar.update(1, hub)
-        hubs = get_hubs(hub,{})
+        if concurrency > 1:
+            hubs = asyncio.run(get_hubs_concurrent(
+                hub, {}, hops,
+                concurrency=concurrency,
+                timeout=timeout,
+                mode=mode,
+                progress=lambda address: bar.update(1, address),
+                stats=stats,
+                window=window,
+                state=state,
+                on_peers=on_peers
+            ))
+        elif mode == 'bfs':
+            hubs = get_hubs_bfs(hub, {}, hops, progress=lambda address: bar.update(1, address), stats=stats, window=window, state=state, timeout=timeout, on_peers=on_peers)
+        else:
+            bar.update(1, hub)
+            hubs = get_hubs(hub, {}, stats=stats, window=window, state=state, timeout=timeout, on_peers=on_peers)
+            stats['stop_reason'] = 'unreachable' if not hubs else 'hops'
+            if hubs:
+                for i in range(hops-1):
+                    if window and window.converged():
+                        stats['stop_reason'] = 'converged'
+                        break
+                    bar.update(1, hub)
+                    hub = pick_random_hub(list(hubs.keys()), state)
+                    hubs = get_hubs(hub, hubs, stats=stats, window=window, state=state, timeout=timeout, on_peers=on_peers)
+        _save_hub_state(writer, state)
+        if archive:
+            archive.close()
         if not hubs:
             click.echo(f'Unable to contact {hub}')
             sys.exit(1)
-        for i in range(hops-1):
-            bar.update(1, hub)
-            hub = random.choice(list(hubs.keys()))
-            hubs = get_hubs(hub,hubs)
             
         bar.update(1,'Done.')
+        ts = int(time.time())
+        writer.call(lambda conn: edges.save(conn, ts))
+        writer.execute("""INSERT OR REPLACE INTO kv VALUES ('LAST_SCAN', unixepoch('now'))""")
+        writer.execute("""INSERT INTO scan_stats (hubs, queried, unreachable, stop_reason) VALUES (?,?,?,?)""",
+            (len(hubs), stats.get('queried', 0), stats.get('unreachable', 0), stats.get('stop_reason')))
     click.echo(f'Hubs found: {len(hubs)}')
-    for h in hubs:
-        h_ip,h_port = h.split(':')
-        h_app_ver   = hubs[h]['appv']
-        h_proto_ver = hubs[h]['hubv']
-        h_dnsname   = hubs[h]['dns_name']
-        h_ts        = hubs[h]['timestamp']
-        db_cursor.execute("""
-            INSERT OR REPLACE INTO hub (ip, port, dnsname, proto_version, app_version, ts) VALUES (?,?,?,?,?,datetime(?/1000, 'unixepoch'))
-            """, 
-            (h_ip, h_port, h_dnsname, h_proto_ver, h_app_ver, h_ts)
-        )
-        # click.echo(f'{h}\t{hubs[h]['appv']}\t{datetime.fromtimestamp(int(hubs[h]['timestamp']/1000), tz=None)}', file=out)
-    db_cursor.execute("""INSERT OR REPLACE INTO kv VALUES ('LAST_SCAN', unixepoch('now'))""")
-    db_cursor.execute("""INSERT INTO scan_stats (hubs) VALUES (?)""", (len(hubs),))
-
-    db_conn.commit()
+    click.echo(f"Hubs queried: {stats.get('queried', 0)}, unreachable: {stats.get('unreachable', 0)}, skipped (circuit open): {stats.get('skipped', 0)}")
+    if mode == 'bfs':
+        click.echo(f"Hubs left in frontier: {stats.get('frontier', 0)}")
+    click.echo(f"Stopped: {stats.get('stop_reason')}")
+    if archive:
+        click.echo(f"Archived {archive.records} peer lists as scan {archive.scan_id}")
     click.echo('Database updated.')
     
 
+# A hub keeps the fields of the newest contact info seen for it.
+HUB_UPSERT = """
+    INSERT INTO hub (addr_id, port, dnsname, proto_version, app_version, ts)
+    VALUES ((SELECT addr_id FROM addr WHERE ip = ?),?,?,?,?,?)
+    ON CONFLICT (addr_id, port) DO UPDATE SET
+        dnsname = excluded.dnsname, proto_version = excluded.proto_version, app_version = excluded.app_version, ts = excluded.ts
+    WHERE hub.ts IS NULL OR excluded.ts >= hub.ts
+    """
+
+def _save_hubs(writer, hubs):
+    """Queue a hubs dict (as built by get_hubs) on a DbWriter. Hubs without an IP address are skipped."""
+    rows = []
+    for h, hub in hubs.items():
+        (ip, _, port) = h.rpartition(':')
+        packed = pack_ip(ip)
+        if packed is not None:
+            rows.append((packed, int(port), hub['dns_name'], hub['hubv'], hub['appv'], hub['timestamp'] // 1000))
+    writer.executemany("""INSERT OR IGNORE INTO addr (ip) VALUES (?)""", [(r[0],) for r in rows])
+    writer.executemany(HUB_UPSERT, rows)
+
+@fc_nmap.command('ingest-archive')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('--processes', default=None, type=int, help='Segments parsed in parallel. Defaults to the number of CPUs.')
+def ingest_archive(paths, processes):
+    """Load hubs from archived peer lists (scan --archive) into the database
+
+    PATHS are segment files or directories of them.
+    """
+    (hubs, responses) = ingest(paths, processes)
+    with db.DbWriter() as writer:
+        _save_hubs(writer, hubs)
+        # updatedb expects a scan to have happened.
+        writer.execute("""INSERT OR IGNORE INTO kv VALUES ('LAST_SCAN', unixepoch('now'))""")
+    click.echo(f'Hubs found in {responses} peer lists: {len(hubs)}')
+    click.echo('Database updated.')
+
 @fc_nmap.command()
 @click.argument('output', default='-', type=click.File('w'))
 @click.option('--hub-info', is_flag=True, help="Collect hub info for hubs")
 @click.option('--hub-location', is_flag=True, help="Look up hubs geolocation")
 @click.option('--geo-api-key', help="API key to be used for IP-to-geolocation service", show_default=True, envvar='FCNMAP_GEO_API_KEY')
+@click.option('--geo-db', type=click.Path(exists=True, dir_okay=False), help='Locate IPs offline with this compiled range database (see compile-geodb) instead of ip2location.io.')
+@click.option('--geo-workers', default=ip2location.WORKERS, help='Number of IPs to look up in parallel.', show_default=True)
+@click.option('--geo-rate', default=float(ip2location.RATE), help='Maximum ip2location requests per second.', show_default=True)
+@click.option('--geo-daily-quota', default=ip2location.DAILY_QUOTA, help='Maximum ip2location requests per day, counted across runs.', show_default=True, envvar='FCNMAP_GEO_DAILY_QUOTA')
+@click.option('--geo-prefix-cache', is_flag=True, help='Look up one IP per network prefix, and reuse the location of a fresh neighbour in the same prefix.')
+@click.option('--geo-prefix-bits', type=(int, int), default=(24, 48), help='IPv4 and IPv6 prefix lengths for --geo-prefix-cache.', show_default=True)
 @click.option('--age-threshold', default=86400, help="Only check records no older than INTEGER.", show_default=True)
-@click.option('--timeout', default=5, help='Seconds to wait before gRPC timeout.')
-def updatedb(output, age_threshold, hub_info, hub_location, geo_api_key, timeout):
+@click.option('--timeout', default=5, help='Seconds to wait before gRPC timeout, for hubs without latency history.')
+@click.option('--race', is_flag=True, help="Probe plaintext IP and TLS dnsname in parallel, keep the first answer.")
+@click.option('--workers', default=1, help='Number of hubs to probe in parallel.', show_default=True)
+@click.option('--batch-size', default=500, help='Commit hub info after this many rows.', show_default=True)
+@click.option('--batch-seconds', default=5.0, help='Commit hub info at least this often, in seconds.', show_default=True)
+@click.option('--allow-private', is_flag=True, help="Also probe hubs on private/loopback addresses (e.g. fc-nmap simulate).")
+@click.option('--record', type=click.Path(dir_okay=False, writable=True), help='Save every hub response, its timing and errors to this cassette file.')
+@click.option('--replay', type=click.Path(exists=True, dir_okay=False), help='Answer hub calls from this cassette file instead of the network.')
+@click.option('--replay-timing', is_flag=True, help='With --replay, make each call take as long as it did when recorded.')
+def updatedb(output, age_threshold, hub_info, hub_location, geo_api_key, geo_db, geo_workers, geo_rate, geo_daily_quota, geo_prefix_cache, geo_prefix_bits, timeout, race, workers, batch_size, batch_seconds, allow_private, record, replay, replay_timing):
     """Collect addtional information about each hub
     """
+    _use_cassette(record, replay, replay_timing)
     if hub_location:
-        if not geo_api_key:
-            click.echo("You will need to pass --geo-api-location a key from ip2location.io")
+        if not geo_api_key and not geo_db:
+            click.echo("You will need to pass --geo-api-location a key from ip2location.io, or a --geo-db")
             sys.exit(1)
         else:
-            update_hub_geo(geo_api_key)
+            update_hub_geo(geo_api_key, geo_workers, geo_rate, geo_daily_quota, geo_db, geo_prefix_bits if geo_prefix_cache else None)
     if hub_info:
         click.echo("Connecting to each hub to collect more info")
-        update_hub_info(output, age_threshold, timeout)
+        update_hub_info(output, age_threshold, timeout, race, workers, batch_size, batch_seconds, allow_private)
 
-def update_hub_info(output, age_threshold, timeout):
-    conn = sqlite3.connect('hubs.db')
+def update_hub_info(output, age_threshold, timeout, race=False, workers=1, batch_size=500, batch_seconds=5, allow_private=False, dbpath=None):
+    conn = db.connect(dbpath)
+    state = _hub_state(conn)
     # r_cursor = conn.cursor()
     # w_cursor = conn.cursor()
     cursor = conn.cursor()
@@ -106,218 +248,371 @@ def update_hub_info(output, age_threshold, timeout):
 
     cursor.execute("""
         SELECT COUNT(*) FROM hub LEFT JOIN hub_info
-        ON hub.ip = hub_info.ip AND hub.port = hub_info.port 
-        WHERE unixepoch(hub.ts) > unixepoch('now') - ? -- hub was active in the last N seconds
-        AND ( unixepoch(hub_info.updated_at) < unixepoch('now') -  ? -- hub info was not updated in the last N seconds
+        ON hub.hub_id = hub_info.hub_id
+        WHERE hub.ts > unixepoch('now') - ? -- hub was active in the last N seconds
+        AND ( hub_info.updated_at < unixepoch('now') -  ? -- hub info was not updated in the last N seconds
         OR hub_info.updated_at IS NULL )
         """, (age_threshold, age_threshold,))
     count = cursor.fetchone()[0]
 
     # r_cursor.execute("""SELECT * FROM hub""")
     cursor.execute("""
-        SELECT hub.ip, hub.port, hub.dnsname FROM hub LEFT JOIN hub_info
-        ON hub.ip = hub_info.ip AND hub.port = hub_info.port 
-        WHERE unixepoch(hub.ts) > unixepoch('now') - ? -- hub was active in the last N seconds
-        AND ( unixepoch(hub_info.updated_at) < unixepoch('now') -  ? -- hub info was not updated in the last N seconds
+        SELECT addr.ip, hub.port, hub.dnsname, hub.hub_id FROM hub
+        JOIN addr ON addr.addr_id = hub.addr_id
+        LEFT JOIN hub_info ON hub.hub_id = hub_info.hub_id
+        WHERE hub.ts > unixepoch('now') - ? -- hub was active in the last N seconds
+        AND ( hub_info.updated_at < unixepoch('now') -  ? -- hub info was not updated in the last N seconds
         OR hub_info.updated_at IS NULL )
         """, (age_threshold, age_threshold))
-    records = cursor.fetchall()
+    records = [(unpack_ip(r[0]), *r[1:]) for r in cursor.fetchall()]
+    # Hubs that failed repeatedly are left alone until their backoff expires.
+    records = [r for r in records if not state.is_open(f'{r[0]}:{r[1]}')]
+    if len(records) < count:
+        click.echo(f"Skipping {count - len(records)} hubs that failed repeatedly")
+        count = len(records)
+
+    def probe(r):
+        return (r, get_hub_info(address=r[0],port=r[1],dnsname=r[2], timeout=timeout, state=state, race=race, allow_private=allow_private))
+
+    conn.close()
 
+    # Workers only talk to the network; rows are handed to the writer thread.
+    pool = ThreadPoolExecutor(max_workers=workers)
+    futures = [pool.submit(probe, r) for r in records]
     i = 0
-    with click.progressbar(records, 
+    with db.DbWriter(dbpath, batch_size, batch_seconds) as writer, click.progressbar(records, 
         label=f"Scanning {count} hubs",
         length=count, 
         width=0, 
         bar_template='%(label)s  %(bar)s  %(info)s', 
         item_show_func=lambda a: a.rjust(21) if a else None
         ) as bar:
-        for r in records:
-            i+=1
-            bar.update(1, f"{i}/{count}".rjust(10) )
-            info = get_hub_info(address=r[0],port=r[1],dnsname=r[2], timeout=timeout)
-            if info:
-                cursor.execute(
-                    """
-                    INSERT OR REPLACE INTO hub_info 
-                    (ip, port, version, is_syncing, nickname, root_hash, peerid, fid, num_messages, num_fid_events, num_fname_events, approx_size, updated_at) 
-                    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,datetime())
-                    """,
-                    (r[0],r[1], #ip:port
-                    info.version,
-                    info.is_syncing,
-                    info.nickname,
-                    info.root_hash,
-                    info.peerId,
-                    info.hub_operator_fid,
-                    info.db_stats.num_messages,
-                    info.db_stats.num_fid_events,
-                    info.db_stats.num_fname_events,
-                    info.db_stats.approx_size
-                    )
+        try:
+            for done in as_completed(futures):
+                (r, info) = done.result()
+                i+=1
+                bar.update(1, f"{i}/{count}".rjust(10) )
+                if info:
+                    writer.execute(
+                        """
+                        INSERT OR REPLACE INTO hub_info 
+                        (hub_id, version, is_syncing, nickname, root_hash, peerid, fid, num_messages, num_fid_events, num_fname_events, approx_size, updated_at) 
+                        VALUES (?,?,?,?,?,?,?,?,?,?,?,unixepoch())
+                        """,
+                        (r[3],
+                        info.version,
+                        info.is_syncing,
+                        info.nickname,
+                        info.root_hash,
+                        info.peerId,
+                        info.hub_operator_fid,
+                        info.db_stats.num_messages,
+                        info.db_stats.num_fid_events,
+                        info.db_stats.num_fname_events,
+                        info.db_stats.approx_size
+                        )
+                        )
+                else:
+                    # Keep what the hub told us last time; hub_failure tracks the failure itself.
+                    writer.execute(
+                        """
+                        INSERT INTO hub_info (hub_id, updated_at) VALUES (?,unixepoch())
+                        ON CONFLICT (hub_id) DO UPDATE SET updated_at = excluded.updated_at
+                        """,
+                        (r[3],)
                     )
-                line = f"{r[0]}:{r[1]} -- {info.hub_operator_fid}"
-            else:
-                cursor.execute(
-                    """
-                    INSERT OR REPLACE INTO hub_info (ip, port, updated_at) VALUES (?,?,datetime())
-                    """,
-                    (r[0],r[1])
-                )
-                line = f"{r[0]}:{r[1]} -- Unknown".ljust(40)
-            conn.commit()
-            # print(line)
-            #print(line, f"{r[0]}:{r[1]}".ljust(30), end='\r', flush=True)
+        finally:
+            # On Ctrl-C, drop the probes that have not started instead of waiting for
+            # all of them. The ones in flight end at their deadline and still update
+            # state, so they are waited for before it is saved.
+            for future in futures:
+                future.cancel()
+            pool.shutdown(wait=True)
+            _save_hub_state(writer, state)
         
 
-def update_hub_geo(geo_api_key):
-    conn = sqlite3.connect('hubs.db')
+# addr columns filled by update_hub_geo, and the ip2location.io response field for each.
+GEO_COLUMNS = {
+    'country_code': 'country_code',
+    'country_name': 'country_name',
+    'region_name': 'region_name',
+    'city_name': 'city_name',
+    'latitude': 'latitude',
+    'longitude': 'longitude',
+    'zip_code': 'zip_code',
+    'time_zone': 'time_zone',
+    'as_number': 'asn',
+    'as_name': 'as',
+    'is_proxy': 'is_proxy',
+}
+
+# GEO_COLUMNS that hold for a whole network; the only ones the prefix cache copies to neighbouring IPs.
+PREFIX_COLUMNS = ('country_code', 'country_name', 'as_number', 'as_name')
+
+def update_hub_geo(geo_api_key, workers=ip2location.WORKERS, rate=ip2location.RATE, daily_quota=ip2location.DAILY_QUOTA, geo_db=None, prefix_cache=None):
+    """Locate hub IPs with ip2location.io, or with a compiled local database (`geo_db`, see compile-geodb).
+
+    Every IP is looked up once, however many hubs run on it. With
+    `prefix_cache` = (IPv4 bits, IPv6 bits), IPs that share a network
+    prefix share one lookup, and prefixes with a fresh location in addr
+    reuse it without any. Only the looked-up IP gets every GEO_COLUMNS
+    field; its neighbours get PREFIX_COLUMNS and the source's updated_at.
+    """
+    max_age = 60*60*24*100
+    conn = db.connect()
     cursor = conn.cursor()
     cursor.execute("""
-        SELECT COUNT(*) FROM hub LEFT JOIN addr
-        ON hub.ip = addr.ip
-        WHERE unixepoch('now') - unixepoch(addr.updated_at) > ?
-        OR addr.updated_at IS NULL
-        """, (60*60*24*100,))
-    count = cursor.fetchone()[0]
+        SELECT addr.ip, addr.addr_id FROM addr
+        WHERE (addr.updated_at < unixepoch('now') - ? OR addr.updated_at IS NULL)
+        AND EXISTS (SELECT 1 FROM hub WHERE hub.addr_id = addr.addr_id)
+        """, (max_age,))
+    records = [(unpack_ip(ip), addr_id) for ip, addr_id in cursor.fetchall()]
+    count = len(records)
+    # lookup key (the IP, or its prefix) -> the [(ip, addr_id)] it locates
+    groups = {}
+    cached = {}
+    if prefix_cache:
+        key = lambda ip: ip2location.prefix(ip, *prefix_cache)
+        cursor.execute(f"""
+            SELECT ip, updated_at, {', '.join(GEO_COLUMNS)} FROM addr
+            WHERE updated_at >= unixepoch('now') - ? AND country_code IS NOT NULL
+            """, (max_age,))
+        for row in cursor:
+            cached.setdefault(key(unpack_ip(row[0])), (dict(zip(GEO_COLUMNS.values(), row[2:])), row[1]))
+    else:
+        key = lambda ip: ip
+    # One IP per group that is not cached gets looked up.
+    pending = {}
+    for ip, addr_id in records:
+        groups.setdefault(key(ip), []).append((ip, addr_id))
+        if key(ip) not in cached:
+            pending.setdefault(key(ip), ip)
+    if prefix_cache:
+        click.echo(f"{count} IPs in {len(groups)} prefixes, {sum(1 for k in groups if k in cached)} located from neighbours")
+    if geo_db:
+        local = geodb.GeoDB(geo_db)
+        lookups = ((ip, local.lookup(ip)) for ip in pending.values())
+    else:
+        quota = ip2location.DailyQuota(daily_quota, conn)
+        if quota.remaining < len(pending):
+            click.echo(f"Daily ip2location quota: {quota.remaining} of {daily_quota} lookups left, {len(pending) - quota.remaining} IPs will wait for another day")
+        lookups = ip2location.resolve_ips(geo_api_key, list(pending.values()), workers, ip2location.RateLimiter(rate), quota)
+    conn.close()
 
-    # r_cursor.execute("""SELECT * FROM hub""")
-    cursor.execute("""
-        SELECT hub.ip FROM hub LEFT JOIN addr
-        ON hub.ip = addr.ip
-        WHERE unixepoch('now') - unixepoch(addr.updated_at) > ?
-        OR addr.updated_at IS NULL
-        """, (60*60*24*100,))
-    records = cursor.fetchall()
+    def located():
+        # (key, the IP looked up or None, location, updated_at of a cached location)
+        for k in groups:
+            if k in cached:
+                yield (k, None, *cached[k])
+        for ip, info in lookups:
+            yield (key(ip), ip, info, None)
 
     i = 0
-    with click.progressbar(records, 
-        label=f"Looking up {count} IPs",
-        length=count, 
+    with db.DbWriter() as writer, click.progressbar(
+        label=f"Looking up {len(pending)} IPs",
+        length=len(groups) if geo_db else min(len(groups), len(groups) - len(pending) + quota.remaining), 
         width=0, 
         bar_template='%(label)s  %(bar)s  %(info)s', 
         item_show_func=lambda a: a.rjust(21) if a else None
         ) as bar:
-        for r in records:
-            i+=1
-            #bar.update(1, f"{i}/{count}".rjust(10) )
-            info = resolve_ip(geo_api_key, r[0])
-            if info:
-                cursor.execute(
-                    """
-                    INSERT OR REPLACE INTO addr VALUES (?,?,?,?,?,?,?,?,?,?,?,?,datetime())
-                    """,(
-                        info['ip'],
-                        info['country_code'], 
-                        info['country_name'],
-                        info['region_name'],
-                        info['city_name'],
-                        info['latitude'],
-                        info['longitude'],
-                        info['zip_code'],
-                        info['time_zone'],
-                        info['asn'],
-                        info['as'],
-                        info['is_proxy']
+        try:
+            for k, looked_up, info, updated_at in located():
+                i+=1
+                if info:
+                    writer.executemany(
+                        f"""
+                        UPDATE addr SET {', '.join(f'{c} = ?' for c in GEO_COLUMNS)}, updated_at = unixepoch()
+                        WHERE addr_id = ?
+                        """,
+                        [(*(info[f] for f in GEO_COLUMNS.values()), addr_id) for ip, addr_id in groups[k] if ip == looked_up]
                     )
-                )
-                conn.commit()
-                bar.update(1, f"{i}/{count}".rjust(10) )
+                    writer.executemany(
+                        f"""
+                        UPDATE addr SET {', '.join(f'{c} = ?' for c in PREFIX_COLUMNS)}, updated_at = coalesce(?, unixepoch())
+                        WHERE addr_id = ?
+                        """,
+                        [(*(info[GEO_COLUMNS[c]] for c in PREFIX_COLUMNS), updated_at, addr_id) for ip, addr_id in groups[k] if ip != looked_up]
+                    )
+                    bar.update(1, f"{i}/{len(groups)}".rjust(10) )
+                else:
+                    bar.update(1, f"ERROR {i}/{len(groups)}".rjust(10) )
+        finally:
+            if geo_db:
+                local.close()
             else:
-                bar.update(1, f"ERROR {i}/{count}".rjust(10) )
-            #print(line, f"{r[0]}:{r[1]}".ljust(30), end='\r', flush=True)
-    conn.commit()
+                writer.call(quota.save)
     
+@fc_nmap.command('compile-geodb')
+@click.argument('csv_file', type=click.Path(exists=True, dir_okay=False))
+@click.argument('out', default='geo.db', type=click.Path(dir_okay=False, writable=True))
+def compile_geodb(csv_file, out):
+    """Compile an IP-range CSV into a database for updatedb --geo-db
+
+    CSV_FILE has one range per row: ip2location LITE files (no header, DB5
+    column order), or files with a header naming ip_from/ip_to or network
+    and country_code, country_name, region_name, city_name, latitude,
+    longitude, asn, as columns.
+    """
+    (ranges, locations) = geodb.compile_csv(csv_file, out)
+    click.echo(f'{out}: {ranges} ranges, {locations} distinct locations.')
+
 @fc_nmap.command()
 def initdb():
     """Initialize the database"""
-    conn = sqlite3.connect('hubs.db')
-    cursor = conn.cursor()
-    cursor.executescript("""
-        CREATE TABLE IF NOT EXISTS kv( 
-            k TEXT NOT NULL PRIMARY KEY, 
-            v INTEGER
-        );
-
-        CREATE TABLE IF NOT EXISTS hub( 
-            ip TEXT, 
-            port INTEGER, 
-            dnsname TEXT, 
-            proto_version TEXT, 
-            app_version TEXT, 
-            ts TEXT, 
-            PRIMARY KEY(ip,port)
-        );
-
-        CREATE INDEX IF NOT EXISTS idx_hub_ip ON hub(ip);
-
-        CREATE TABLE IF NOT EXISTS hub_info( 
-            ip TEXT, 
-            port INTEGER, 
-            version TEXT, 
-            is_syncing BOOL, 
-            nickname TEXT, 
-            root_hash TEXT, 
-            peerid TEXT, 
-            fid INTEGER, 
-            num_messages INTEGER, 
-            num_fid_events INTEGER, 
-            num_fname_events INTEGER, 
-            approx_size INTEGER,
-            updated_at TEXT NOT NULL DEFAULT current_timestamp,
-            PRIMARY KEY(ip,port)
-        );
-
-        CREATE TABLE IF NOT EXISTS addr (
-            ip text NOT NULL PRIMARY KEY, 
-            country_code TEXT, 
-            country_name TEXT,
-            region_name TEXT,
-            city_name TEXT,
-            latitude REAL,
-            longitude REAL,
-            zip_code TEXT,
-            time_zone TEXT,
-            as_number INTEGER,
-            as_name TEXT,
-            is_proxy BOOL,
-            updated_at TEXT NOT NULL DEFAULT current_timestamp
-        );
-
-        CREATE TABLE IF NOT EXISTS scan_stats (
-            ts TEXT NOT NULL DEFAULT current_timestamp,
-            hubs INTEGER DEFAULT 0
-        );
-
-    """)
-    conn.commit()
-    click.echo("hubs.db created.")
+    db.connect()
+    click.echo(f"{db.path()} created.")
+
+@fc_nmap.command()
+@click.option('--dry-run', is_flag=True, help="Run the pending migrations and roll them back, reporting how long each took.")
+@click.option('--explain', is_flag=True, help="Also print every statement the migrations run, with its query plan.")
+def migrate(dry_run, explain):
+    """Upgrade the database to the current schema
+    """
+    conn = db.connect(migrate=False)
+    version = schema_version(conn)
+    click.echo(f"Schema version: {version if version is not None else 'none'}, current: {SCHEMA_VERSION}")
+    if not pending_migrations(conn):
+        create_schema(conn)
+        click.echo("Nothing to migrate.")
+        return
+    for (version, description, seconds, statements) in migrate_schema(conn, dry_run=dry_run, explain=explain):
+        click.echo(f"{version:>4}  {description}  {seconds:.3f}s")
+        for (sql, plan, rows) in statements:
+            click.echo(f"        {sql}" + (f"  [{rows} rows]" if rows != 1 else ""))
+            for line in plan:
+                click.echo(f"            {line}")
+    if dry_run:
+        click.echo(f"Dry run: rolled back, {db.path()} is unchanged.")
+    else:
+        create_schema(conn)
+        click.echo(f"{db.path()} is up to date.")
     
+EXPORTS = {
+    'all': dbexports.export_full,
+    'countries': dbexports.export_countries,
+    'fids': dbexports.export_fids,
+    'app': dbexports.export_app_version,
+    'asn': dbexports.export_asn,
+    'geoip': dbexports.export_latlong,
+    'latency': dbexports.export_latency,
+    'map': dbexports_maps.create_map,
+}
+
+def _reports(ctx, param, value):
+    if value is None:
+        return []
+    reports = [r.strip().lower() for r in value.split(',') if r.strip()]
+    if reports == ['everything']:
+        return [r for r in EXPORTS if r != 'map']
+    for r in reports:
+        if r not in EXPORTS:
+            raise click.BadParameter(f"{r!r} is not one of {', '.join(EXPORTS)}, everything.")
+    return list(dict.fromkeys(reports))
+
 @fc_nmap.command()
 @click.option('--out', default='-', help="Output file, leave empty for stdout")
+@click.option('--out-dir', type=click.Path(file_okay=False, writable=True), help="Write each report to REPORT.tsv in this directory (required for more than one report).")
 @click.option('--max-age', default=86400, help="Only check records that were created/updated in the last INTEGER seconds.", show_default=True)
-@click.option('--report', type=click.Choice(['all', 'countries', 'fids', 'app', 'asn', 'geoip', 'map'], case_sensitive=False))
-def export(out, max_age, report):
-    """Create a tab separated dump of the database"""
-    if report == 'all':
-        dbexports.export_full(dbpath='hubs.db', out=out, max_age=max_age)
-    if report == 'countries':
-        dbexports.export_countries(dbpath='hubs.db', out=out, max_age=max_age)
-    if report == 'fids':
-        dbexports.export_fids(dbpath='hubs.db', out=out, max_age=max_age)
-    if report == 'app':
-        dbexports.export_app_version(dbpath='hubs.db', out=out, max_age=max_age)
-    if report == 'asn':
-        dbexports.export_asn(dbpath='hubs.db', out=out, max_age=max_age)
-    if report == 'geoip':
-        dbexports.export_latlong(dbpath='hubs.db', out=out, max_age=max_age)
-    if report == 'pam':
-        dbexports_maps.map(dbpath='hubs.db', out=out, max_age=max_age)
-    
+@click.option('--report', callback=_reports, help=f"Report to export: {', '.join(EXPORTS)}. Several, comma separated, or 'everything' (all but map) need --out-dir.")
+def export(out, out_dir, max_age, report):
+    """Create a tab separated dump of the database
+
+    Several reports are computed together from one pass over the active
+    hubs; latency (which reads the RPC log) and map run on their own.
+    """
+    db.upgrade()
+    if len(report) > 1 and not out_dir:
+        raise click.UsageError('More than one --report needs --out-dir.')
+    if not out_dir:
+        for r in report:
+            if r == 'map':
+                EXPORTS[r](out=out if out != '-' else 'fc_nmap.html', max_age=max_age)
+            else:
+                EXPORTS[r](out=out, max_age=max_age)
+        return
+    os.makedirs(out_dir, exist_ok=True)
+    paths = dbexports.export_reports([r for r in report if r in dbexports.REPORTS], out_dir, max_age=max_age)
+    if 'latency' in report:
+        paths.append(os.path.join(out_dir, 'latency.tsv'))
+        dbexports.export_latency(out=paths[-1], max_age=max_age)
+    if 'map' in report:
+        dbexports_maps.create_map(out=os.path.join(out_dir, 'fc_nmap.html'), max_age=max_age)
+    for path in paths:
+        click.echo(f"Report saved to {path}")
 
 @fc_nmap.command()
 @click.option('--out', default='fc_nmap.html', help="Output file")
 @click.option('--max-age', default=86400, help="Only check records that were created/updated in the last INTEGER seconds.", show_default=True)
 def map(out, max_age):
-    dbexports_maps.create_map(dbpath='hubs.db', out=out, max_age=max_age)
-    
-    
\ No newline at end of file
+    db.upgrade()
+    dbexports_maps.create_map(out=out, max_age=max_age)
+
+@fc_nmap.command()
+@click.option('--max-age', default=86400, help="Only use peer lists received in the last INTEGER seconds.", show_default=True)
+@click.option('--top', default=20, help='Number of bridging hubs to list.', show_default=True)
+def graph(max_age, top):
+    """Analyze who lists whom as a peer
+    """
+    conn = db.connect()
+    g = load_graph(conn, max_age)
+    if not len(g):
+        click.echo('No peer lists found. Run "fc-nmap scan" first.')
+        sys.exit(1)
+    click.echo(f'Hubs: {len(g)}, edges: {len(g.src)}, observers: {sum(1 for d in g.out_degrees() if d)}')
+    click.echo('In-degree (hubs listing a hub) distribution:')
+    for degree, count in degree_distribution(g.in_degrees()).items():
+        click.echo(f'{degree:>6}\t{count}')
+    components = connected_components(g)
+    click.echo(f'Connected components: {len(components)}, sizes: {", ".join(str(len(c)) for c in components[:10])}{" ..." if len(components) > 10 else ""}')
+    in_degrees = g.in_degrees()
+    points = sorted(articulation_points(g), key=lambda n: in_degrees[n], reverse=True)
+    click.echo(f'Bridging hubs (their loss splits a component): {len(points)}')
+    for node in points[:top]:
+        click.echo(f'{g.addresses[node]:>40}\tin-degree {in_degrees[node]}')
+
+@fc_nmap.command()
+@click.option('--hubs', default=100, help='Number of hubs in the synthetic network.', show_default=True)
+@click.option('--degree', default=8, help='Random peers listed by each hub.', show_default=True)
+@click.option('--latency', default=0.0, help='Mean response latency in seconds.', show_default=True)
+@click.option('--tls-only', default=0.0, help='Fraction of hubs that only accept TLS.', show_default=True)
+@click.option('--timeouts', default=0.0, help='Fraction of hubs that never answer.', show_default=True)
+@click.option('--dead', default=0.0, help='Fraction of hubs with nothing listening.', show_default=True)
+@click.option('--seed', default=None, type=int, help='Random seed, for a reproducible topology.')
+@click.option('--cert-out', default='fc_nmap_sim.pem', help='Where to write the TLS certificate used by TLS-only hubs.', show_default=True)
+def simulate(hubs, degree, latency, tls_only, timeouts, dead, seed, cert_out):
+    """Run a synthetic Farcaster network on loopback ports
+    """
+    topology = Topology(hubs, degree=degree, latency=latency, tls_only=tls_only, timeouts=timeouts, dead=dead, seed=seed)
+    with HubSimulator(topology) as simulator:
+        click.echo(f'{len(topology)} hubs running, {len(topology.alive())} answering. Seed hub: {simulator.address()}')
+        if simulator.certificate:
+            with open(cert_out, 'wb') as f:
+                f.write(simulator.certificate)
+            click.echo(f'TLS-only hubs use a self-signed certificate, run fc-nmap with FCNMAP_SSL_ROOTS={cert_out}')
+        click.echo('Press Ctrl-C to stop.')
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+
+@fc_nmap.command()
+@click.option('--sizes', default='100,1000', help='Comma separated numbers of hubs to benchmark with.', show_default=True)
+@click.option('--only', type=click.Choice(list(benchmarks.BENCHMARKS)), multiple=True, help='Run only these benchmarks (repeatable).')
+@click.option('--out', default='-', help="Write the JSON results here, leave empty for stdout")
+@click.option('--compare', 'baseline', type=click.Path(exists=True, dir_okay=False), help='Baseline JSON from an earlier run. Exit with 1 on regressions.')
+@click.option('--tolerance', default=0.2, help='Allowed drop in rate before a result counts as a regression.', show_default=True)
+def bench(sizes, only, out, baseline, tolerance):
+    """Benchmark scan, probe and export throughput offline
+    """
+    report = benchmarks.run([int(s) for s in sizes.split(',')], only)
+    with click.open_file(out, 'w') as file_h:
+        json.dump(report, file_h, indent=2)
+        file_h.write('\n')
+    if baseline:
+        with open(baseline) as f:
+            regressions = benchmarks.compare(report, json.load(f), tolerance)
+        for r, before in regressions:
+            click.echo(f"REGRESSION {r['name']} size={r['size']}: {r['rate']} {r['unit']} (was {before})", err=True)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,172 @@
+"""Opening hubs.db.
+
+Every command gets its connection from connect(), so they all share the
+same location (--db / FCNMAP_DB) and settings: WAL journaling, so exports
+can read while updatedb writes, synchronous=NORMAL, which in WAL mode only
+syncs at checkpoints, and a larger page cache plus memory-mapped reads.
+"""
+import os
+import queue
+import sqlite3
+import threading
+import time
+from urllib.parse import quote
+
+from . schema import create_schema
+
+DEFAULT_PATH = 'hubs.db'
+
+# Applied to every connection. cache_size is in KiB when negative.
+PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'mmap_size': 256*1024*1024,
+    'cache_size': -64*1024,
+    'temp_store': 'MEMORY',
+}
+
+_path = os.environ.get('FCNMAP_DB', DEFAULT_PATH)
+
+def set_path(path):
+    """Use `path` as the database from now on. Returns the previous one."""
+    global _path
+    previous, _path = _path, path
+    return previous
+
+def path():
+    return _path
+
+def connect(dbpath=None, readonly=False, migrate=True):
+    """Open the database (the current path() by default).
+
+    Read-write connections switch it to WAL and, with `migrate`, apply
+    pending migrations. Read-only ones are opened with mode=ro, so a
+    report can never write or take a write lock.
+    """
+    dbpath = dbpath or _path
+    if readonly:
+        conn = sqlite3.connect(f'file:{quote(os.path.abspath(dbpath))}?mode=ro', uri=True)
+    else:
+        conn = sqlite3.connect(dbpath)
+        conn.execute('PRAGMA journal_mode = WAL')
+    for pragma, value in PRAGMAS.items():
+        conn.execute(f'PRAGMA {pragma} = {value}')
+    if migrate and not readonly:
+        create_schema(conn)
+    return conn
+
+def upgrade(dbpath=None):
+    """Apply pending migrations to an existing database, before opening it read-only."""
+    dbpath = dbpath or _path
+    if os.path.exists(dbpath):
+        connect(dbpath).close()
+
+# Queue item that tells the writer thread to finish.
+_STOP = object()
+
+class DbWriter:
+    """Write-behind writer: statements are queued and run by a background thread.
+
+    Consecutive rows for the same statement go to one executemany, and a
+    transaction is committed every `batch_size` rows or `batch_seconds`,
+    whichever comes first, so a crash loses at most one batch. The queue
+    holds `queue_size` items; when the disk falls behind, producers wait
+    instead of piling up memory. Leaving the `with` block, normally or
+    through an exception such as KeyboardInterrupt, commits everything
+    queued so far.
+    """
+    def __init__(self, dbpath=None, batch_size=500, batch_seconds=5, queue_size=10000):
+        self.dbpath = dbpath or _path
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.rows = 0
+        self.commits = 0
+        self._queue = queue.Queue(queue_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='DbWriter', daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def execute(self, sql, params=()):
+        self._put((sql, params))
+
+    def executemany(self, sql, rows):
+        for params in rows:
+            self._put((sql, params))
+
+    def call(self, fn):
+        """Run fn(conn) on the writer thread, after everything queued before it."""
+        self._put((fn, None))
+
+    def flush(self):
+        """Wait until everything queued so far is committed."""
+        done = threading.Event()
+        self._put((done, None))
+        while not done.wait(0.1) and self._thread.is_alive():
+            pass
+        self._raise()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._put((_STOP, None))
+            self._thread.join()
+        self._raise()
+
+    def _raise(self):
+        if self._error:
+            raise self._error
+
+    def _put(self, item):
+        while True:
+            self._raise()
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _execute(self, conn, pending):
+        for sql, rows in pending:
+            conn.executemany(sql, rows)
+            self.rows += len(rows)
+        pending.clear()
+
+    def _run(self):
+        pending = []  # [(sql, [params, ...])], in queue order
+        count = 0
+        started = 0
+        try:
+            conn = connect(self.dbpath)
+            while True:
+                timeout = max(0, started + self.batch_seconds - time.monotonic()) if count else None
+                try:
+                    (what, params) = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    (what, params) = (None, None)
+                if isinstance(what, str):
+                    if pending and pending[-1][0] == what:
+                        pending[-1][1].append(params)
+                    else:
+                        pending.append((what, [params]))
+                    if not count:
+                        started = time.monotonic()
+                    count += 1
+                    if count < self.batch_size and time.monotonic() - started < self.batch_seconds:
+                        continue
+                self._execute(conn, pending)
+                if callable(what):
+                    what(conn)
+                conn.commit()
+                self.commits += 1
+                count = 0
+                if isinstance(what, threading.Event):
+                    what.set()
+                elif what is _STOP:
+                    break
+            conn.close()
+        except BaseException as e:
+            self._error = e
@@ -1,103 +1,209 @@
-import sqlite3
 import click
+import itertools
+import os
 from datetime import datetime
 
-def export_full(dbpath="hubs.db", out='-', max_age=60*60*24):
+import grpc
+
+from fc_nmap import db
+from fc_nmap.schema import unpack_ip
+
+# Rows fetched from SQLite at a time, and the output buffer size, in bytes.
+# Exports stream: memory does not grow with the number of rows.
+FETCH_SIZE = 10000
+BUFFER_SIZE = 1 << 20
+
+def _rows(cursor):
+    """Iterate over the result of `cursor`, FETCH_SIZE rows at a time."""
+    while rows := cursor.fetchmany(FETCH_SIZE):
+        yield from rows
+
+def _write(out, lines):
+    """Write `lines` to the file `out` ('-' for stdout), one per line."""
+    if out == '-':
+        with click.open_file(out, 'w') as file_h:
+            file_h.writelines(f'{line}\n' for line in lines)
+            file_h.flush()
+    else:
+        with open(out, 'w', buffering=BUFFER_SIZE) as file_h:
+            file_h.writelines(f'{line}\n' for line in lines)
+
+def export_full(dbpath=None, out='-', max_age=60*60*24):
     """Create a tab separated dump of the database"""
-    conn = sqlite3.connect(dbpath)
+    conn = db.connect(dbpath, readonly=True)
     cursor = conn.cursor()
     cursor.execute("""
-        SELECT hub.ip, hub.port, hub.proto_version, hub.app_version, hub.ts, hub_info.fid, addr.country_code, addr.as_name
-        FROM hub LEFT JOIN hub_info ,addr
-        ON hub.ip = hub_info.ip AND hub.port = hub_info.port AND hub.ip = addr.ip
-        WHERE unixepoch(hub.ts) > unixepoch() - ?
+        SELECT addr.ip, hub.port, hub.proto_version, hub.app_version, datetime(hub.ts, 'unixepoch'), hub_info.fid, addr.country_code, addr.as_name
+        FROM hub JOIN addr ON addr.addr_id = hub.addr_id
+        LEFT JOIN hub_info ON hub_info.hub_id = hub.hub_id
+        WHERE hub.ts > unixepoch() - ?
         """, (max_age,))
-    records = cursor.fetchall()
-    with click.open_file(out, 'w') as file_h:
-        for r in records:
-            click.echo(f'{r[0]}\t{r[1]}\t{r[2]}\t{r[3]}\t{r[5] if r[5] else 0}\t{r[6]}\t{r[7]}\t{r[4]}', file=file_h)
+    _write(out, (f'{unpack_ip(r[0])}\t{r[1]}\t{r[2]}\t{r[3]}\t{r[5] if r[5] else 0}\t{r[6]}\t{r[7]}\t{r[4]}' for r in _rows(cursor)))
+    conn.close()
 
-def export_countries(dbpath="hubs.db", out='-', max_age=60*60*24):
-    conn = sqlite3.connect(dbpath)
+def export_countries(dbpath=None, out='-', max_age=60*60*24):
+    conn = db.connect(dbpath, readonly=True)
     cursor = conn.cursor()
     cursor.execute("""
         SELECT count(*) as C, addr.country_code, addr.country_name
         FROM hub LEFT JOIN addr
-        ON hub.ip = addr.ip
-        WHERE unixepoch(hub.ts) > unixepoch() - ?
+        ON hub.addr_id = addr.addr_id
+        WHERE hub.ts > unixepoch() - ?
         GROUP BY addr.country_code
         ORDER BY C DESC
         """, (max_age,))
-    records = cursor.fetchall()
-    file_h = click.open_file(out, 'w')
-    for r in records:
-        click.echo(f'{r[0]}\t{r[1]}\t{r[2]}', file=file_h)
+    _write(out, (f'{r[0]}\t{r[1]}\t{r[2]}' for r in _rows(cursor)))
+    conn.close()
 
-def export_asn(dbpath="hubs.db", out='-', max_age=60*60*24):
-    conn = sqlite3.connect(dbpath)
+def export_asn(dbpath=None, out='-', max_age=60*60*24):
+    conn = db.connect(dbpath, readonly=True)
     cursor = conn.cursor()
     cursor.execute("""
         SELECT count(*) as C, addr.as_number, addr.as_name
         FROM hub LEFT JOIN addr
-        ON hub.ip = addr.ip
-        WHERE unixepoch(hub.ts) > unixepoch() - ?
+        ON hub.addr_id = addr.addr_id
+        WHERE hub.ts > unixepoch() - ?
         GROUP BY addr.as_number
         ORDER BY C DESC
         """, (max_age,))
-    records = cursor.fetchall()
-    file_h = click.open_file(out, 'w')
-    for r in records:
-        click.echo(f'{r[0]}\t{r[1]}\t{r[2]}', file=file_h)
+    _write(out, (f'{r[0]}\t{r[1]}\t{r[2]}' for r in _rows(cursor)))
+    conn.close()
 
-def export_fids(dbpath="hubs.db", out='-', max_age=60*60*24):
-    conn = sqlite3.connect(dbpath)
+def export_fids(dbpath=None, out='-', max_age=60*60*24):
+    conn = db.connect(dbpath, readonly=True)
     cursor = conn.cursor()
     cursor.execute("""
         SELECT hub_info.fid, count(*) AS C
         FROM hub LEFT JOIN hub_info
-        ON hub.ip = hub_info.ip AND hub.port = hub_info.port
-        WHERE unixepoch(hub.ts) > unixepoch() - ?
+        ON hub.hub_id = hub_info.hub_id
+        WHERE hub.ts > unixepoch() - ?
         GROUP BY hub_info.fid
-        ORDER BY C DESC, addr.as_name ASC
+        ORDER BY C DESC, hub_info.fid ASC
         """, (max_age,))
+    _write(out, (f'{r[0]}\t{r[1]}' for r in _rows(cursor)))
+    conn.close()
 
-    records = cursor.fetchall()
-    file_h = click.open_file(out, 'w')
-    for r in records:
-        click.echo(f'{r[0]}\t{r[1]}', file=file_h)
-
-def export_app_version(dbpath="hubs.db", out='-', max_age=60*60*24):
-    conn = sqlite3.connect(dbpath)
+def export_app_version(dbpath=None, out='-', max_age=60*60*24):
+    conn = db.connect(dbpath, readonly=True)
     cursor = conn.cursor()
     cursor.execute("""
         SELECT app_version, count(*) AS C
         FROM hub 
-        WHERE unixepoch(hub.ts) > unixepoch() - ?
+        WHERE hub.ts > unixepoch() - ?
         GROUP BY app_version
         ORDER BY C DESC
         """, (max_age,))
+    _write(out, (f'{r[0]}\t{r[1]}' for r in _rows(cursor)))
+    conn.close()
 
-    records = cursor.fetchall()
-    file_h = click.open_file(out, 'w')
-    for r in records:
-        click.echo(f'{r[0]}\t{r[1]}', file=file_h)
-
-def export_latlong(dbpath="hubs.db", out='-', max_age=60*60*24):
+def export_latlong(dbpath=None, out='-', max_age=60*60*24):
     """Export IP, port, lat, long"""
-    conn = sqlite3.connect(dbpath)
+    conn = db.connect(dbpath, readonly=True)
     cursor = conn.cursor()
     cursor.execute("""
         SELECT count(*), addr.latitude, addr.longitude, addr.country_code, addr.zip_code
-        FROM hub LEFT JOIN hub_info ,addr
-        ON hub.ip = hub_info.ip AND hub.port = hub_info.port AND hub.ip = addr.ip
-        WHERE unixepoch(hub.ts) > unixepoch() - ?
+        FROM hub JOIN addr
+        ON hub.addr_id = addr.addr_id
+        WHERE hub.ts > unixepoch() - ?
+        AND addr.updated_at IS NOT NULL
         GROUP BY latitude, longitude
         """, (max_age,))
-    records = cursor.fetchall()
-    with click.open_file(out, 'w') as file_h:
-        for r in records:
-            click.echo(f'{r[0]}\t{r[1]}\t{r[2]}\t{r[3]}\t{r[4]}', file=file_h)
+    _write(out, (f'{r[0]}\t{r[1]}\t{r[2]}\t{r[3]}\t{r[4]}' for r in _rows(cursor)))
+    conn.close()
+
+def _percentile(values, p):
+    """p-th percentile (nearest rank) of sorted values."""
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def _latency_lines(groups):
+    for key in sorted(groups, key=lambda k: -groups[k][1]):
+        ok, calls = groups[key]
+        ok.sort()
+        p = [_percentile(ok, q) if ok else '' for q in (50, 90, 99)]
+        yield f'{key}\t{calls}\t{calls - len(ok)}\t{p[0]}\t{p[1]}\t{p[2]}'
+
+def export_latency(dbpath=None, out='-', max_age=60*60*24):
+    """Export calls, errors and p50/p90/p99 latency (ms) per hub and per ASN"""
+    conn = db.connect(dbpath, readonly=True)
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT addr.ip, hub.port, addr.as_number, addr.as_name, rpc_log.status, rpc_log.ms
+        FROM rpc_log
+        JOIN hub ON hub.hub_id = rpc_log.hub_id
+        JOIN addr ON addr.addr_id = hub.addr_id
+        WHERE rpc_log.ts > unixepoch() - ?
+        """, (max_age,))
+    by_hub = {}
+    by_asn = {}
+    for ip, port, as_number, as_name, status, ms in _rows(cursor):
+        for groups, key in ((by_hub, f'{unpack_ip(ip)}:{port}'), (by_asn, f'{as_number}\t{as_name}')):
+            ok, calls = groups.get(key, ([], 0))
+            if status == grpc.StatusCode.OK.value[0]:
+                ok.append(ms)
+            groups[key] = (ok, calls + 1)
+    conn.close()
+    _write(out, itertools.chain((f'hub\t{line}' for line in _latency_lines(by_hub)), (f'asn\t{line}' for line in _latency_lines(by_asn))))
+
+# Reports export_reports() computes together, in one pass over the active hubs.
+REPORTS = ('all', 'countries', 'fids', 'app', 'asn', 'geoip')
+
+def _null_first(item):
+    """Sort key for SQL's ascending order, where NULL comes first."""
+    return tuple((v is not None, v) for v in (item if isinstance(item, tuple) else (item,)))
 
+def _by_count(groups):
+    """(key, [count, ...]) items by count descending, then key ascending."""
+    return sorted(groups.items(), key=lambda item: (-item[1][0], _null_first(item[0])))
+
+def export_reports(reports, out_dir, dbpath=None, max_age=60*60*24):
+    """Write each of `reports` (names from REPORTS) to <out_dir>/<report>.tsv.
+
+    The active hubs are read once and every report is computed from that
+    single pass; each file has the same lines as the report's export_*
+    function. Returns the paths written.
+    """
+    conn = db.connect(dbpath, readonly=True)
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT addr.ip, hub.port, hub.proto_version, hub.app_version, datetime(hub.ts, 'unixepoch'), hub_info.fid,
+        addr.country_code, addr.country_name, addr.as_number, addr.as_name,
+        addr.latitude, addr.longitude, addr.zip_code, addr.updated_at
+        FROM hub LEFT JOIN addr ON addr.addr_id = hub.addr_id
+        LEFT JOIN hub_info ON hub_info.hub_id = hub.hub_id
+        WHERE hub.ts > unixepoch() - ?
+        """, (max_age,))
+    paths = {report: os.path.join(out_dir, f'{report}.tsv') for report in reports}
+    countries = {}  # country_code -> [hubs, country_name]
+    asns = {}  # as_number -> [hubs, as_name]
+    fids = {}  # fid -> [hubs]
+    apps = {}  # app_version -> [hubs]
+    places = {}  # (latitude, longitude) -> [hubs, country_code, zip_code]
+    full = open(paths['all'], 'w', buffering=BUFFER_SIZE) if 'all' in paths else None
+    try:
+        for (ip, port, proto, app, seen, fid, country_code, country_name, as_number, as_name, lat, long, zip_code, located) in _rows(cursor):
+            if full:
+                full.write(f'{unpack_ip(ip) if ip else None}\t{port}\t{proto}\t{app}\t{fid if fid else 0}\t{country_code}\t{as_name}\t{seen}\n')
+            countries[country_code] = [countries.get(country_code, [0])[0] + 1, country_name]
+            asns[as_number] = [asns.get(as_number, [0])[0] + 1, as_name]
+            fids[fid] = [fids.get(fid, [0])[0] + 1]
+            apps[app] = [apps.get(app, [0])[0] + 1]
+            if ip is not None and located is not None:
+                places[(lat, long)] = [places.get((lat, long), [0])[0] + 1, country_code, zip_code]
+    finally:
+        if full:
+            full.close()
+    conn.close()
+    lines = {
+        'countries': (f'{c}\t{k}\t{name}' for k, (c, name) in _by_count(countries)),
+        'asn': (f'{c}\t{k}\t{name}' for k, (c, name) in _by_count(asns)),
+        'fids': (f'{k}\t{c}' for k, (c,) in _by_count(fids)),
+        'app': (f'{k}\t{c}' for k, (c,) in _by_count(apps)),
+        'geoip': (f'{c}\t{k[0]}\t{k[1]}\t{code}\t{zip_code}' for k, (c, code, zip_code) in sorted(places.items(), key=lambda item: _null_first(item[0]))),
+    }
+    for report in reports:
+        if report != 'all':
+            _write(paths[report], lines[report])
+    return list(paths.values())
 
 if __name__ == "__main__":
     export_full()
@@ -1,21 +1,23 @@
 import folium
-import sqlite3
 import click
 
-def get_latlong(dbpath="hubs.db", max_age=60*60*24):
-    conn = sqlite3.connect(dbpath)
+from fc_nmap import db
+
+def get_latlong(dbpath=None, max_age=60*60*24):
+    conn = db.connect(dbpath, readonly=True)
     cursor = conn.cursor()
     cursor.execute("""
         SELECT count(*), addr.latitude, addr.longitude, addr.country_name, addr.city_name, addr.country_code
-        FROM hub LEFT JOIN hub_info ,addr
-        ON hub.ip = hub_info.ip AND hub.port = hub_info.port AND hub.ip = addr.ip
-        WHERE unixepoch(hub.ts) > unixepoch() - ?
+        FROM hub JOIN addr
+        ON hub.addr_id = addr.addr_id
+        WHERE hub.ts > unixepoch() - ?
+        AND addr.updated_at IS NOT NULL
         GROUP BY latitude, longitude
         """, (max_age,))
     records = cursor.fetchall()
     return records
 
-def create_map(dbpath="hubs.db", out='fc_nmap.html', max_age=60*60*24):
+def create_map(dbpath=None, out='fc_nmap.html', max_age=60*60*24):
     hubs = get_latlong(dbpath, max_age)
 
     m = folium.Map(location=(20,15), zoom_start=3)
@@ -0,0 +1,178 @@
+"""Offline IP geolocation from a local IP-range database.
+
+compile_csv() turns a range CSV (ip2location LITE or GeoLite2 style) into
+a single binary file:
+
+    MAGIC, number of ranges (u32), number of locations (u32)
+    ranges:    first address (16 bytes), last address (16 bytes), location (u32)
+    offsets:   locations + 1 offsets (u32) into the location blob
+    locations: one JSON array of LOCATION_FIELDS per distinct location
+
+Addresses are 128-bit big-endian, IPv4 mapped into ::ffff:0:0/96, so
+comparing the raw bytes orders them numerically. Ranges are sorted by
+their first address; GeoDB maps the file and finds an address with a
+bisect over the range table, without loading it.
+"""
+import bisect
+import csv
+import ipaddress
+import itertools
+import json
+import mmap
+import struct
+
+MAGIC = b'FCNMAPG1'
+HEADER = struct.Struct('<II')
+RANGE = struct.Struct('<16s16sI')
+OFFSET = struct.Struct('<I')
+
+# Keys of a location, named like the ip2location.io response fields.
+LOCATION_FIELDS = ('country_code', 'country_name', 'region_name', 'city_name', 'latitude', 'longitude', 'asn', 'as')
+
+# CSV header names accepted for each field. Files without a header are
+# read in the ip2location DB5 column order: ip_from, ip_to, country_code,
+# country_name, region_name, city_name, latitude, longitude.
+COLUMNS = {
+    'start': ('ip_from', 'start', 'start_ip', 'network_start_ip'),
+    'end': ('ip_to', 'end', 'end_ip', 'network_last_ip'),
+    'network': ('network', 'cidr'),
+    'country_code': ('country_code', 'country_iso_code'),
+    'country_name': ('country_name',),
+    'region_name': ('region_name', 'subdivision_1_name'),
+    'city_name': ('city_name',),
+    'latitude': ('latitude',),
+    'longitude': ('longitude',),
+    'asn': ('asn', 'as_number', 'autonomous_system_number'),
+    'as': ('as', 'as_name', 'autonomous_system_organization'),
+}
+DB5_COLUMNS = ['start', 'end', 'country_code', 'country_name', 'region_name', 'city_name', 'latitude', 'longitude']
+
+def _key(ip):
+    """16-byte sort key of an address (an ipaddress object)."""
+    if ip.version == 4:
+        ip = ipaddress.IPv6Address(0xffff00000000 | int(ip))
+    return ip.packed
+
+def _parse_address(value):
+    """An address given as an IP or as the integer ip2location uses."""
+    value = value.strip()
+    if value.isdigit():
+        n = int(value)
+        return ipaddress.IPv4Address(n) if n < 2**32 else ipaddress.IPv6Address(n)
+    return ipaddress.ip_address(value)
+
+def _columns(header):
+    names = [h.strip().lower() for h in header]
+    columns = {}
+    for field, aliases in COLUMNS.items():
+        for alias in aliases:
+            if alias in names:
+                columns[field] = names.index(alias)
+                break
+    return columns
+
+def _value(field, raw):
+    raw = raw.strip()
+    if raw in ('', '-'):
+        return None
+    if field in ('latitude', 'longitude'):
+        return float(raw)
+    if field == 'asn':
+        raw = raw.upper()
+        return raw[2:] if raw.startswith('AS') else raw
+    return raw
+
+def read_csv(path):
+    """Yield (first key, last key, location tuple) for every range in the CSV."""
+    with open(path, newline='', encoding='utf-8') as f:
+        rows = csv.reader(f)
+        first = next(rows, None)
+        if first is None:
+            return
+        columns = _columns(first)
+        if 'network' not in columns and 'start' not in columns:
+            # No header: the first row is data.
+            columns = {field: i for i, field in enumerate(DB5_COLUMNS)}
+            rows = itertools.chain([first], rows)
+        for row in rows:
+            if 'network' in columns:
+                network = ipaddress.ip_network(row[columns['network']].strip())
+                (start, end) = (network[0], network[-1])
+            else:
+                (start, end) = (_parse_address(row[columns['start']]), _parse_address(row[columns['end']]))
+            location = tuple(_value(f, row[columns[f]]) if f in columns else None for f in LOCATION_FIELDS)
+            yield (_key(start), _key(end), location)
+
+def compile_csv(csv_path, out_path):
+    """Compile a range CSV into a GeoDB file. Returns (ranges, distinct locations)."""
+    ranges = []
+    locations = {}
+    for start, end, location in read_csv(csv_path):
+        ranges.append((start, end, locations.setdefault(location, len(locations))))
+    ranges.sort()
+    blobs = [json.dumps(location, separators=(',', ':')).encode() for location in locations]
+    with open(out_path, 'wb') as f:
+        f.write(MAGIC + HEADER.pack(len(ranges), len(blobs)))
+        for r in ranges:
+            f.write(RANGE.pack(*r))
+        offset = 0
+        for blob in blobs:
+            f.write(OFFSET.pack(offset))
+            offset += len(blob)
+        f.write(OFFSET.pack(offset))
+        for blob in blobs:
+            f.write(blob)
+    return (len(ranges), len(blobs))
+
+class _Starts:
+    """The first addresses of the mapped range table, as a sequence bisect can search."""
+    def __init__(self, data, count):
+        self._data = data
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        start = len(MAGIC) + HEADER.size + i * RANGE.size
+        return self._data[start:start + 16]
+
+class GeoDB:
+    """Look up addresses in a compiled GeoDB file, memory-mapped."""
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._data[:len(MAGIC)] != MAGIC:
+            self._data.close()
+            raise ValueError(f'{path} is not an fc-nmap geo database (see fc-nmap compile-geodb)')
+        (self.ranges, self.locations) = HEADER.unpack_from(self._data, len(MAGIC))
+        self._starts = _Starts(self._data, self.ranges)
+        self._offsets = len(MAGIC) + HEADER.size + self.ranges * RANGE.size
+        self._blobs = self._offsets + (self.locations + 1) * OFFSET.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._data.close()
+
+    def _location(self, n):
+        (start, end) = struct.unpack_from('<II', self._data, self._offsets + n * OFFSET.size)
+        return json.loads(self._data[self._blobs + start:self._blobs + end])
+
+    def lookup(self, ip):
+        """{field: value} for LOCATION_FIELDS, like an ip2location.io response; None if no range has it."""
+        try:
+            key = _key(ipaddress.ip_address(ip))
+        except ValueError:
+            return None
+        i = bisect.bisect_right(self._starts, key) - 1
+        if i < 0:
+            return None
+        (_, end, location) = RANGE.unpack_from(self._data, len(MAGIC) + HEADER.size + i * RANGE.size)
+        if key > end:
+            return None
+        return {**dict(zip(LOCATION_FIELDS, self._location(location))), 'zip_code': None, 'time_zone': None, 'is_proxy': None}
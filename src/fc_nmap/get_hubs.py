@@ -1,38 +1,175 @@
+import asyncio
 import os
+import queue
 import sys
-from . GrpcClient import HubService
+from . GrpcClient import ChannelPool, HubService
 from grpc import FutureTimeoutError, RpcError, StatusCode
 import time, datetime, random
+from collections import deque
 
 from ipaddress import ip_address 
 
+# Seconds the plaintext GetInfo gets as a head start before the TLS attempt joins the race.
+RACE_STAGGER = 0.25
 
-def _get_peers(hub_address):
-	try:
-		hub = HubService(hub_address, use_async=False, timeout=5)
-		peers = hub.GetCurrentPeers()
-		hub.close()
+
+def _transports(state, address):
+	"""use_ssl values to try, in order: the cached transport first, plaintext first if unknown."""
+	known = state.transport(address) if state else None
+	return (False, True) if known is None else (known, not known)
+
+def _deadline(state, address, timeout):
+	return state.deadline(address, timeout) if state else timeout
+
+def _get_peers(hub_address, state=None, timeout=5):
+	error = None
+	deadline = _deadline(state, hub_address, timeout)
+	for use_ssl in _transports(state, hub_address):
+		hub = HubService(hub_address, use_async=False, timeout=deadline, use_ssl=use_ssl)
+		try:
+			started = time.monotonic()
+			peers = hub.GetCurrentPeers(timeout=deadline)
+		except RpcError as e:
+			_log_rpc(state, hub_address, 'GetCurrentPeers', use_ssl, time.monotonic() - started, e.code())
+			error = e
+			if e.code() == StatusCode.UNAVAILABLE:
+				continue
+			break
+		finally:
+			hub.close()
+		elapsed = _log_rpc(state, hub_address, 'GetCurrentPeers', use_ssl, time.monotonic() - started, StatusCode.OK, peers)
+		_record_success(state, hub_address, use_ssl, elapsed)
 		return peers
-	except RpcError as error:
-		if error.code() == StatusCode.UNAVAILABLE:
-			try:
-				hub = HubService(hub_address, use_async=False, timeout=5, use_ssl=True)
-				peers = hub.GetCurrentPeers()
-				hub.close()
-				return peers
-			except:
-				return None
-		return None
+	_record_failure(state, hub_address, error, deadline)
+	return None
+
+def _log_rpc(state, address, method, use_ssl, elapsed, code, response=None):
+	if state:
+		state.record_rpc(address, method, use_ssl, code, elapsed, response.ByteSize() if response is not None else None)
+	return elapsed
+
+def _record_success(state, address, use_ssl, elapsed):
+	if state:
+		state.set_transport(address, use_ssl)
+		state.record_success(address)
+		state.record_latency(address, elapsed)
+
+def _record_failure(state, address, error, deadline=None):
+	if state:
+		state.record_failure(address, error.code() if error else None)
+		if deadline and error and error.code() == StatusCode.DEADLINE_EXCEEDED:
+			state.record_timeout(address, deadline)
+
+def pick_random_hub(keys, state=None, tries=10):
+	"""Pick one of `keys` at random, avoiding hubs whose circuit is open when possible."""
+	for _ in range(tries):
+		address = random.choice(keys)
+		if not (state and state.is_open(address)):
+			break
+	return address
+
+class DiscoveryWindow:
+	"""Sliding window over the number of new hubs each GetCurrentPeers response adds.
 
-def get_hubs(hub_address, hubs):
+	The scan has converged once the last `size` responses added less than
+	`min_rate` new hubs each, on average.
+	"""
+	def __init__(self, size=10, min_rate=0.5):
+		self.size = size
+		self.min_rate = min_rate
+		self._new = deque(maxlen=size)
+
+	def add(self, new):
+		self._new.append(new)
+
+	def rate(self):
+		return sum(self._new) / len(self._new) if self._new else None
+
+	def converged(self):
+		return len(self._new) == self.size and self.rate() < self.min_rate
+
+def get_hubs(hub_address, hubs, stats=None, window=None, state=None, timeout=5, on_peers=None):
 	if not hub_address:
 		print("No hub address. Check .env.sample")
 		sys.exit(1)
-	peers = _get_peers(hub_address)
+	peers = _get_peers(hub_address, state, timeout)
+	_count(stats, 'queried')
 	if not peers:
+		_count(stats, 'unreachable')
 		return hubs
+	if on_peers:
+		on_peers(hub_address, peers)
+	new = _merge_peers(peers, hubs)
+	if window:
+		window.add(len(new))
+	return hubs
+
+def get_hubs_bfs(hub_address, hubs, budget, progress=None, stats=None, window=None, state=None, timeout=5, on_peers=None):
+	"""Breadth-first crawl that asks every discovered hub for its peers exactly once.
+
+	Stops when the frontier is empty, `budget` hubs have been queried or
+	`window` reports that new responses no longer add enough hubs.
+	`on_peers`, if given, is called with the address and the raw response
+	of every hub that answered.
+	"""
+	if not hub_address:
+		print("No hub address. Check .env.sample")
+		sys.exit(1)
+	frontier = deque([hub_address])
+	visited = {hub_address}
+	queried = 0
+	while frontier and queried < budget:
+		address = frontier.popleft()
+		if state and state.is_open(address) and address != hub_address:
+			_count(stats, 'skipped')
+			continue
+		peers = _get_peers(address, state, timeout)
+		queried += 1
+		_count(stats, 'queried')
+		if peers:
+			if on_peers:
+				on_peers(address, peers)
+			new = _merge_peers(peers, hubs)
+			_extend_frontier(new, frontier, visited)
+			if window:
+				window.add(len(new))
+		else:
+			_count(stats, 'unreachable')
+		if progress:
+			progress(address)
+		if window and window.converged():
+			break
+	if stats is not None:
+		stats['frontier'] = len(frontier)
+		stats['stop_reason'] = _stop_reason(hubs, window, frontier)
+	return hubs
+
+def _stop_reason(hubs, window, frontier=None):
+	if not hubs:
+		return 'unreachable'
+	if window and window.converged():
+		return 'converged'
+	if frontier is not None and not frontier:
+		return 'frontier'
+	return 'hops'
+
+def _count(stats, key, n=1):
+	if stats is not None:
+		stats[key] = stats.get(key, 0) + n
+
+def _extend_frontier(ids, frontier, visited):
+	for id in ids:
+		if id not in visited:
+			visited.add(id)
+			frontier.append(id)
+
+def _merge_peers(peers, hubs):
+	"""Merge a ContactInfoResponse into hubs, return the ids that were not in hubs before."""
+	new = []
 	for c in peers.contacts:
 		id = f'{c.rpc_address.address}:{c.rpc_address.port}'
+		if id not in hubs:
+			new.append(id)
 		if id not in hubs or hubs[id]['timestamp'] < c.timestamp:
 			hubs[id] = {
 				'family': c.rpc_address.family,
@@ -41,33 +178,185 @@ def get_hubs(hub_address, hubs):
 				'appv': c.app_version,
 				'timestamp': c.timestamp
 				}
+	return new
+
+async def _get_peers_async(hub_address, pool, timeout=5, state=None):
+	error = None
+	deadline = _deadline(state, hub_address, timeout)
+	for use_ssl in _transports(state, hub_address):
+		hub = HubService(hub_address, use_async=True, use_ssl=use_ssl, pool=pool)
+		try:
+			started = time.monotonic()
+			peers = await hub.GetCurrentPeers(timeout=deadline)
+		except RpcError as e:
+			_log_rpc(state, hub_address, 'GetCurrentPeers', use_ssl, time.monotonic() - started, e.code())
+			error = e
+			if e.code() == StatusCode.UNAVAILABLE:
+				continue
+			break
+		finally:
+			hub.close()
+		elapsed = _log_rpc(state, hub_address, 'GetCurrentPeers', use_ssl, time.monotonic() - started, StatusCode.OK, peers)
+		_record_success(state, hub_address, use_ssl, elapsed)
+		return peers
+	_record_failure(state, hub_address, error, deadline)
+	return None
+
+async def get_hubs_concurrent(hub_address, hubs, hops, concurrency=8, timeout=5, mode='random', progress=None, stats=None, window=None, state=None, on_peers=None):
+	"""Query up to `hops` hubs, keeping `concurrency` GetCurrentPeers calls in flight.
+
+	Each response is merged into `hubs` as soon as it arrives. In `random` mode
+	the next hub to query is picked at random from the table as it is at that
+	moment, in `bfs` mode it is taken from the frontier of hubs not queried yet.
+	`progress`, if given, is called with the address of every finished call,
+	`on_peers` with the address and raw response of every successful one.
+	No new calls are started once `window` reports convergence.
+	"""
+	if not hub_address:
+		print("No hub address. Check .env.sample")
+		sys.exit(1)
+	frontier = deque()
+	visited = {hub_address}
+	pool = ChannelPool(use_async=True)
+	try:
+		in_flight = {asyncio.ensure_future(_get_peers_async(hub_address, pool, timeout, state)): hub_address}
+		started = 1
+		while in_flight:
+			done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+			for task in done:
+				address = in_flight.pop(task)
+				# A call cancelled under us (e.g. its channel closed) fails its hub, not the scan.
+				peers = None if task.cancelled() else task.result()
+				_count(stats, 'queried')
+				if peers:
+					if on_peers:
+						on_peers(address, peers)
+					new = _merge_peers(peers, hubs)
+					if mode == 'bfs':
+						_extend_frontier(new, frontier, visited)
+					if window:
+						window.add(len(new))
+				else:
+					_count(stats, 'unreachable')
+				if progress:
+					progress(address)
+			keys = None
+			while started < hops and len(in_flight) < concurrency and not (window and window.converged()):
+				if mode == 'bfs':
+					while frontier and state and state.is_open(frontier[0]):
+						frontier.popleft()
+						_count(stats, 'skipped')
+					if not frontier:
+						break
+					address = frontier.popleft()
+				else:
+					if not hubs:
+						break
+					if keys is None:
+						keys = list(hubs.keys())
+					address = pick_random_hub(keys, state)
+				in_flight[asyncio.ensure_future(_get_peers_async(address, pool, timeout, state))] = address
+				started += 1
+
+	finally:
+		await pool.aclose()
+	if stats is not None:
+		stats['frontier'] = len(frontier)
+		stats['stop_reason'] = _stop_reason(hubs, window, frontier if mode == 'bfs' else None)
 	return hubs
 
 
 def _get_hub_info(address, port, use_ssl=False, timeout=5):
+	hub = HubService(f'{address}:{port}', use_async=False, timeout=timeout, use_ssl=use_ssl)
 	try:
-		hub = HubService(f'{address}:{port}', use_async=False, timeout=timeout, use_ssl=use_ssl)
 		info = hub.GetInfo(db_stats=True, timeout=timeout)
-		hub.close()
 		return (None, info)
 	except RpcError as e:
 		return(e, None)
+	finally:
+		hub.close()
 
-def get_hub_info(address, port, dnsname, timeout=5):
-	if not ip_address(address).is_global:
+def _race_hub_info(address, port, dnsname, timeout=5, stagger=RACE_STAGGER, state=None):
+	"""Race plaintext GetInfo on the IP against TLS GetInfo on the dnsname.
+
+	The TLS attempt starts after `stagger` seconds, or as soon as the
+	plaintext one fails. The first answer wins and the other call is
+	cancelled. Returns (use_ssl, error, info, elapsed), like _get_hub_info
+	plus the transport that answered and how long its call took.
+	Both calls, including the cancelled one, are logged to `state`.
+	"""
+	results = queue.Queue()
+	calls = []
+	def start(host, use_ssl):
+		hub = HubService(f'{host}:{port}', use_async=False, timeout=timeout, use_ssl=use_ssl)
+		started = time.monotonic()
+		call = hub.GetInfoFuture(db_stats=True, timeout=timeout)
+		def done(call):
+			elapsed = time.monotonic() - started
+			hub.close()
+			response = call.result() if call.code() == StatusCode.OK else None
+			_log_rpc(state, f'{address}:{port}', 'GetInfo', use_ssl, elapsed, call.code(), response)
+			results.put((use_ssl, call, elapsed))
+		call.add_done_callback(done)
+		calls.append(call)
+	start(address, False)
+	try:
+		first = results.get(timeout=stagger)
+	except queue.Empty:
+		first = None
+	if first and first[1].exception() is None:
+		return (False, None, first[1].result(), first[2])
+	start(dnsname, True)
+	pending = 2 if first is None else 1
+	while pending:
+		(use_ssl, call, elapsed) = results.get()
+		pending -= 1
+		if call.exception() is None:
+			for other in calls:
+				if other is not call:
+					other.cancel()
+			return (use_ssl, None, call.result(), elapsed)
+	return (None, call.exception(), None, elapsed)
+
+def get_hub_info(address, port, dnsname, timeout=5, state=None, race=False, allow_private=False):
+	"""GetInfo from a hub, trying plaintext on the IP and TLS on the dnsname.
+
+	With `race`, hubs whose transport is not cached get both attempts in
+	parallel (see _race_hub_info) instead of one after the other.
+	Hubs on non-global addresses are skipped unless `allow_private`.
+	"""
+	if not allow_private and not ip_address(address).is_global:
 		return None
-	(error, info) = _get_hub_info(address, port, use_ssl=False, timeout=timeout)
-	if error:
-		if error.code() == StatusCode.DEADLINE_EXCEEDED:
-			return
-		if error.code() == StatusCode.UNAVAILABLE and dnsname.strip():
-			(error,info) = _get_hub_info(dnsname, port, use_ssl=True)
-			if not error:
-				return info
-			else:
-				#print(address, port, dnsname, error.code(), error.details())
-				return None
-		else:
-			return 
-	else:
-		return info
\ No newline at end of file
+	key = f'{address}:{port}'
+	has_dnsname = dnsname and dnsname.strip()
+	known = state.transport(key) if state else None
+	deadline = _deadline(state, key, timeout)
+	if race and has_dnsname and known is None:
+		(use_ssl, error, info, elapsed) = _race_hub_info(address, port, dnsname, timeout=deadline, state=state)
+		if error:
+			_record_failure(state, key, error, deadline)
+			return None
+		_record_success(state, key, use_ssl, elapsed)
+		if use_ssl and state:
+			state.set_transport(f'{dnsname}:{port}', True)
+		return info
+	attempts = [(address, False)]
+	if has_dnsname:
+		attempts.append((dnsname, True))
+	if known:
+		# Known to be TLS-only: skip the plaintext round trip.
+		attempts.reverse()
+	for (host, use_ssl) in attempts:
+		started = time.monotonic()
+		(error, info) = _get_hub_info(host, port, use_ssl=use_ssl, timeout=deadline)
+		elapsed = _log_rpc(state, key, 'GetInfo', use_ssl, time.monotonic() - started, error.code() if error else StatusCode.OK, info)
+		if not error:
+			_record_success(state, key, use_ssl, elapsed)
+			if use_ssl and state:
+				state.set_transport(f'{dnsname}:{port}', True)
+			return info
+		if error.code() != StatusCode.UNAVAILABLE:
+			#print(address, port, dnsname, error.code(), error.details())
+			break
+	_record_failure(state, key, error, deadline)
+	return None
@@ -0,0 +1,158 @@
+"""Who-lists-whom graph of the network, from the peer lists a scan receives.
+
+Every hub that answers GetCurrentPeers adds observer -> contact edges to the
+`edge` table, keyed by hub_id.
+load_graph() reads the edges once into compressed sparse row arrays, and
+the analytics below work on those arrays instead of querying per hub.
+"""
+from array import array
+from collections import Counter
+
+from . schema import intern_hubs, unpack_ip
+
+class EdgeRecorder:
+    """Collect observer -> contact edges during a scan. Pass `add` as a crawl's on_peers."""
+    def __init__(self):
+        self._edges = {}  # observer -> contact addresses
+
+    def __len__(self):
+        return sum(len(contacts) for contacts in self._edges.values())
+
+    def add(self, observer, peers):
+        contacts = {f'{c.rpc_address.address}:{c.rpc_address.port}' for c in peers.contacts}
+        contacts.discard(observer)
+        self._edges[observer] = contacts
+
+    def save(self, conn, ts):
+        """Replace the stored edges of every observer seen, stamped with `ts` (epoch seconds)."""
+        addresses = set(self._edges)
+        for contacts in self._edges.values():
+            addresses.update(contacts)
+        # Observers reached by hostname (the seed hub, usually) have no hub_id and are left out.
+        ids = intern_hubs(conn, addresses)
+        edges = {o: contacts for o, contacts in self._edges.items() if o in ids}
+        conn.executemany("""DELETE FROM edge WHERE src = ?""", ((ids[o],) for o in edges))
+        conn.executemany("""
+            INSERT OR REPLACE INTO edge (src, dst, ts) VALUES (?,?,?)
+            """, ((ids[o], ids[c], ts) for o, contacts in edges.items() for c in contacts if c in ids))
+        self._edges = {}
+
+def _csr(n, src, dst):
+    """(offsets, targets): the targets of node i are targets[offsets[i]:offsets[i+1]]."""
+    offsets = array('l', [0]) * (n + 1)
+    for s in src:
+        offsets[s + 1] += 1
+    for i in range(n):
+        offsets[i + 1] += offsets[i]
+    targets = array('l', [0]) * len(src)
+    position = array('l', offsets)
+    for s, d in zip(src, dst):
+        targets[position[s]] = d
+        position[s] += 1
+    return offsets, targets
+
+class Graph:
+    """Directed graph over hub addresses, nodes numbered 0..n-1.
+
+    `out` holds the CSR arrays of the edges as reported, `undirected` the
+    same edges in both directions, without duplicates.
+    """
+    def __init__(self, addresses, src, dst):
+        self.addresses = addresses
+        self.src = src
+        self.dst = dst
+        n = len(addresses)
+        self.out = _csr(n, src, dst)
+        pairs = {(min(s, d), max(s, d)) for s, d in zip(src, dst)}
+        self.undirected = _csr(n,
+            array('l', [p[0] for p in pairs] + [p[1] for p in pairs]),
+            array('l', [p[1] for p in pairs] + [p[0] for p in pairs]))
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def out_degrees(self):
+        offsets = self.out[0]
+        return [offsets[i + 1] - offsets[i] for i in range(len(self))]
+
+    def in_degrees(self):
+        degrees = [0] * len(self)
+        for d in self.dst:
+            degrees[d] += 1
+        return degrees
+
+def load_graph(conn, max_age=86400):
+    """The graph of the edges seen in the last `max_age` seconds."""
+    rows = conn.execute("""SELECT src, dst FROM edge WHERE ts > unixepoch('now') - ?""", (max_age,))
+    index = {}
+    src = array('l')
+    dst = array('l')
+    for s, d in rows:
+        src.append(index.setdefault(s, len(index)))
+        dst.append(index.setdefault(d, len(index)))
+    addresses = {
+        hub_id: f'{unpack_ip(ip)}:{port}'
+        for hub_id, ip, port in conn.execute("""SELECT hub.hub_id, addr.ip, hub.port FROM hub JOIN addr ON addr.addr_id = hub.addr_id""")
+    }
+    return Graph([addresses[hub_id] for hub_id in index], src, dst)
+
+def degree_distribution(degrees):
+    """{degree: number of hubs}, sorted by degree."""
+    return dict(sorted(Counter(degrees).items()))
+
+def connected_components(graph):
+    """Weakly connected components as lists of nodes, largest first (union-find)."""
+    parent = list(range(len(graph)))
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+    for s, d in zip(graph.src, graph.dst):
+        (a, b) = (find(s), find(d))
+        if a != b:
+            parent[a] = b
+    components = {}
+    for node in range(len(graph)):
+        components.setdefault(find(node), []).append(node)
+    return sorted(components.values(), key=len, reverse=True)
+
+def articulation_points(graph):
+    """Nodes whose removal splits their component (iterative Tarjan, undirected edges)."""
+    (offsets, targets) = graph.undirected
+    n = len(graph)
+    discovered = [-1] * n
+    low = [0] * n
+    points = set()
+    time = 0
+    for root in range(n):
+        if discovered[root] != -1:
+            continue
+        discovered[root] = low[root] = time
+        time += 1
+        children = 0
+        # (node, parent, next edge to look at)
+        stack = [(root, -1, offsets[root])]
+        while stack:
+            (v, parent, i) = stack[-1]
+            if i < offsets[v + 1]:
+                stack[-1] = (v, parent, i + 1)
+                w = targets[i]
+                if discovered[w] == -1:
+                    discovered[w] = low[w] = time
+                    time += 1
+                    if v == root:
+                        children += 1
+                    stack.append((w, v, offsets[w]))
+                elif w != parent:
+                    low[v] = min(low[v], discovered[w])
+            else:
+                stack.pop()
+                if stack:
+                    u = stack[-1][0]
+                    low[u] = min(low[u], low[v])
+                    if u != root and low[v] >= discovered[u]:
+                        points.add(u)
+        if children > 1:
+            points.add(root)
+    return points
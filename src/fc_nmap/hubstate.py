@@ -0,0 +1,150 @@
+import threading
+import time
+from collections import deque
+
+from fc_nmap.schema import RPC_METHODS, intern_hubs
+
+TRANSPORT_TTL = 60*60*24*7
+
+# Consecutive failures before a hub's circuit opens, and the backoff that
+# follows: BACKOFF_BASE seconds, doubling with every further failure.
+FAILURE_THRESHOLD = 2
+BACKOFF_BASE = 60*10
+BACKOFF_MAX = 60*60*24*7
+
+# Per-hub RPC deadline: DEADLINE_FACTOR times the p95 of the last
+# LATENCY_SAMPLES successful calls, kept within [DEADLINE_FLOOR, DEADLINE_CEILING].
+# Hubs with fewer than MIN_LATENCY_SAMPLES samples get the caller's default.
+LATENCY_SAMPLES = 20
+MIN_LATENCY_SAMPLES = 3
+DEADLINE_FACTOR = 3
+DEADLINE_FLOOR = 1
+DEADLINE_CEILING = 30
+
+# rpc_log rows older than this are deleted on save().
+RPC_LOG_RETENTION = 60*60*24*30
+
+class HubState:
+    """What we learned about individual hubs, kept across runs in hubs.db.
+
+    Loaded once when a command starts, updated by the gRPC calls (possibly
+    from several threads) and written back with `save()`.
+    """
+    def __init__(self, conn=None, transport_ttl=TRANSPORT_TTL):
+        self.transport_ttl = transport_ttl
+        self._transports = {}
+        self._dirty_transports = set()
+        self._failures = {}  # address -> [failures, last_code, next_retry]
+        self._dirty_failures = set()
+        self._latencies = {}  # address -> deque of seconds, most recent last
+        self._dirty_latencies = set()
+        self._rpc_log = []
+        self._lock = threading.Lock()
+        if conn:
+            self.load(conn)
+
+    def load(self, conn):
+        cursor = conn.execute("""
+            SELECT address, use_ssl FROM transport WHERE updated_at > ?
+            """, (int(time.time()) - self.transport_ttl,))
+        with self._lock:
+            for address, use_ssl in cursor:
+                self._transports[address] = bool(use_ssl)
+        cursor = conn.execute("""SELECT address, failures, last_code, next_retry FROM hub_failure""")
+        with self._lock:
+            for address, failures, last_code, next_retry in cursor:
+                self._failures[address] = [failures, last_code, next_retry]
+        cursor = conn.execute("""SELECT address, samples FROM hub_latency""")
+        with self._lock:
+            for address, samples in cursor:
+                self._latencies[address] = deque((int(ms)/1000 for ms in samples.split(',')), maxlen=LATENCY_SAMPLES)
+
+    def save(self, conn):
+        now = int(time.time())
+        with self._lock:
+            transports = [(a, self._transports[a], now) for a in self._dirty_transports]
+            self._dirty_transports.clear()
+            failures = [(a, *self._failures[a]) for a in self._dirty_failures if a in self._failures]
+            recovered = [(a,) for a in self._dirty_failures if a not in self._failures]
+            self._dirty_failures.clear()
+            latencies = [(a, ','.join(str(round(t*1000)) for t in self._latencies[a])) for a in self._dirty_latencies]
+            self._dirty_latencies.clear()
+            rpc_log, self._rpc_log = self._rpc_log, []
+        conn.executemany("""
+            INSERT OR REPLACE INTO transport (address, use_ssl, updated_at) VALUES (?,?,?)
+            """, transports)
+        conn.executemany("""
+            INSERT OR REPLACE INTO hub_failure (address, failures, last_code, next_retry) VALUES (?,?,?,?)
+            """, failures)
+        conn.executemany("""DELETE FROM hub_failure WHERE address = ?""", recovered)
+        conn.executemany("""
+            INSERT OR REPLACE INTO hub_latency (address, samples) VALUES (?,?)
+            """, latencies)
+        # Calls to addresses that are not an IP, like a seed hub given by name, have no hub_id and are not logged.
+        hub_ids = intern_hubs(conn, {entry[1] for entry in rpc_log})
+        conn.executemany("""
+            INSERT INTO rpc_log (ts, hub_id, method, tls, status, ms, size) VALUES (?,?,?,?,?,?,?)
+            """, [(ts, hub_ids[address], *rest) for ts, address, *rest in rpc_log if address in hub_ids])
+        conn.execute("""DELETE FROM rpc_log WHERE ts < ?""", (now - RPC_LOG_RETENTION,))
+        conn.commit()
+
+    def transport(self, address):
+        """True if `address` is known to need TLS, False if plaintext works, None if unknown."""
+        with self._lock:
+            return self._transports.get(address)
+
+    def set_transport(self, address, use_ssl):
+        with self._lock:
+            self._transports[address] = use_ssl
+            self._dirty_transports.add(address)
+
+    def record_success(self, address):
+        with self._lock:
+            if self._failures.pop(address, None):
+                self._dirty_failures.add(address)
+
+    def record_failure(self, address, code=None):
+        """Count a failed call. `code` is the grpc.StatusCode, if there was one."""
+        with self._lock:
+            entry = self._failures.setdefault(address, [0, None, 0])
+            entry[0] += 1
+            entry[1] = code.name if code is not None else None
+            if entry[0] >= FAILURE_THRESHOLD:
+                backoff = min(BACKOFF_BASE * 2**(entry[0] - FAILURE_THRESHOLD), BACKOFF_MAX)
+                entry[2] = int(time.time()) + backoff
+            self._dirty_failures.add(address)
+
+    def is_open(self, address):
+        """True while `address` failed too often recently and should not be called."""
+        with self._lock:
+            entry = self._failures.get(address)
+            return bool(entry) and entry[0] >= FAILURE_THRESHOLD and entry[2] > time.time()
+
+    def record_latency(self, address, seconds):
+        """Add the duration of a call to `address`."""
+        with self._lock:
+            self._latencies.setdefault(address, deque(maxlen=LATENCY_SAMPLES)).append(seconds)
+            self._dirty_latencies.add(address)
+
+    def record_timeout(self, address, deadline):
+        """A call to `address` ran out of its `deadline` (seconds).
+
+        The deadline counts as a latency sample, so a hub that slowed down
+        gets DEADLINE_FACTOR times longer next time, up to DEADLINE_CEILING,
+        instead of timing out at its old pace until its circuit opens.
+        """
+        self.record_latency(address, deadline)
+
+    def deadline(self, address, default):
+        """Seconds to allow for the next call to `address`, based on its recent latency."""
+        with self._lock:
+            samples = sorted(self._latencies.get(address, ()))
+        if len(samples) < MIN_LATENCY_SAMPLES:
+            return default
+        p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+        return min(max(p95 * DEADLINE_FACTOR, DEADLINE_FLOOR), DEADLINE_CEILING)
+
+    def record_rpc(self, address, method, use_ssl, code, seconds, size=None):
+        """Log one call: its grpc.StatusCode, wall time and response size in bytes."""
+        with self._lock:
+            self._rpc_log.append((int(time.time()), address, RPC_METHODS[method], use_ssl, code.value[0], round(seconds*1000), size))
@@ -1,22 +1,142 @@
+import ipaddress
 import requests
 import os
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 
 import time, datetime, random
 
 API_ENDPOINT = 'https://api.ip2location.io/'
 
-def resolve_ip(API_KEY, ip):
-	r = requests.get(API_ENDPOINT, params={
-			'key': API_KEY,
-			'format': 'json',
-			'ip': ip
-		})
+# Default lookup pool size, requests per second and lookups per (UTC) day.
+WORKERS = 8
+RATE = 10
+DAILY_QUOTA = 1000
+
+_session = None
+_pool_size = 0
+_session_lock = threading.Lock()
+
+def session(pool_size=WORKERS):
+	"""The keep-alive HTTP session shared by every lookup, keeping up to `pool_size` connections."""
+	global _session, _pool_size
+	with _session_lock:
+		if _session is None:
+			_session = requests.Session()
+		if pool_size > _pool_size:
+			# A bigger pool replaces the adapter; connections in the old one are dropped.
+			for scheme in ('https://', 'http://'):
+				_session.mount(scheme, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+			_pool_size = pool_size
+		return _session
+
+class RateLimiter:
+	"""Token bucket: `rate` requests per second on average, bursts of up to `burst`."""
+	def __init__(self, rate, burst=1):
+		self.rate = rate
+		self.burst = burst
+		self._tokens = burst
+		self._updated = time.monotonic()
+		self._lock = threading.Lock()
+
+	def acquire(self):
+		"""Take a token, waiting for one if the bucket is empty."""
+		while True:
+			with self._lock:
+				now = time.monotonic()
+				self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+				self._updated = now
+				if self._tokens >= 1:
+					self._tokens -= 1
+					return
+				wait = (1 - self._tokens) / self.rate
+			time.sleep(wait)
+
+class DailyQuota:
+	"""At most `limit` lookups per UTC day, counted across runs in kv (GEO_QUOTA_DAY, GEO_LOOKUPS)."""
+	def __init__(self, limit, conn=None):
+		self.limit = limit
+		self.day = int(time.time()) // 86400
+		self.used = 0
+		self._lock = threading.Lock()
+		if conn:
+			self.load(conn)
+
+	def load(self, conn):
+		kv = dict(conn.execute("""SELECT k, v FROM kv WHERE k IN ('GEO_QUOTA_DAY', 'GEO_LOOKUPS')"""))
+		with self._lock:
+			if kv.get('GEO_QUOTA_DAY') == self.day:
+				self.used = kv.get('GEO_LOOKUPS') or 0
+
+	def save(self, conn):
+		with self._lock:
+			(day, used) = (self.day, self.used)
+		conn.executemany("""INSERT OR REPLACE INTO kv VALUES (?,?)""", [('GEO_QUOTA_DAY', day), ('GEO_LOOKUPS', used)])
+
+	@property
+	def remaining(self):
+		return max(0, self.limit - self.used)
+
+	def take(self):
+		"""Count one lookup. False, without counting, once today's quota is used up."""
+		with self._lock:
+			today = int(time.time()) // 86400
+			if today != self.day:
+				(self.day, self.used) = (today, 0)
+			if self.used >= self.limit:
+				return False
+			self.used += 1
+			return True
+
+def prefix(ip, v4=24, v6=48):
+	"""The network of `ip`: its /`v4` for IPv4, /`v6` for IPv6."""
+	address = ipaddress.ip_address(ip)
+	return str(ipaddress.ip_network(f'{ip}/{v4 if address.version == 4 else v6}', strict=False))
+
+def resolve_ip(API_KEY, ip, timeout=10):
+	try:
+		r = session().get(API_ENDPOINT, params={
+				'key': API_KEY,
+				'format': 'json',
+				'ip': ip
+			}, timeout=timeout)
+	except requests.RequestException:
+		return None
 	if r.status_code == requests.codes.ok:
 		return r.json()
 	else:
 		return None
 
+def resolve_ips(API_KEY, ips, workers=WORKERS, limiter=None, quota=None):
+	"""Look up `ips` on a pool of `workers` threads, yielding (ip, info or None) as they complete.
+
+	Every request waits for a token from `limiter` and is counted
+	against `quota`; IPs left once the quota is used up are not looked
+	up, and not yielded.
+	"""
+	def lookup(ip):
+		if quota and not quota.take():
+			return (ip, False)
+		if limiter:
+			limiter.acquire()
+		return (ip, resolve_ip(API_KEY, ip))
+	# One keep-alive connection per worker.
+	session(workers)
+	pool = ThreadPoolExecutor(max_workers=workers)
+	futures = [pool.submit(lookup, ip) for ip in ips]
+	try:
+		for done in as_completed(futures):
+			(ip, info) = done.result()
+			if info is not False:
+				yield (ip, info)
+	finally:
+		# Stopped early (e.g. Ctrl-C): drop the lookups that have not started.
+		for future in futures:
+			future.cancel()
+		pool.shutdown(wait=False)
+
 if __name__ == "__main__":
-    r = resolve_ips(None, ['38.242.248.195','173.212.230.134'])
-    print(r)
+	r = dict(resolve_ips(os.environ.get('FCNMAP_GEO_API_KEY'), ['38.242.248.195','173.212.230.134']))
+	print(r)
@@ -0,0 +1,370 @@
+import time
+from ipaddress import ip_address
+
+import grpc
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv( 
+    k TEXT NOT NULL PRIMARY KEY, 
+    v INTEGER
+);
+
+-- All timestamps are INTEGER seconds since the epoch, so freshness filters
+-- (ts > unixepoch() - ?) can use the indexes on them.
+
+-- One row per IP address (packed, 4 or 16 bytes), with its geolocation.
+-- updated_at is NULL until the address has been looked up.
+CREATE TABLE IF NOT EXISTS addr (
+    addr_id INTEGER PRIMARY KEY,
+    ip BLOB NOT NULL UNIQUE,
+    country_code TEXT, 
+    country_name TEXT,
+    region_name TEXT,
+    city_name TEXT,
+    latitude REAL,
+    longitude REAL,
+    zip_code TEXT,
+    time_zone TEXT,
+    as_number INTEGER,
+    as_name TEXT,
+    is_proxy BOOL,
+    updated_at INTEGER
+);
+
+CREATE INDEX IF NOT EXISTS idx_addr_updated_at ON addr(updated_at);
+
+CREATE TABLE IF NOT EXISTS hub( 
+    hub_id INTEGER PRIMARY KEY,
+    addr_id INTEGER NOT NULL REFERENCES addr(addr_id),
+    port INTEGER NOT NULL, 
+    dnsname TEXT, 
+    proto_version TEXT, 
+    app_version TEXT, 
+    ts INTEGER, 
+    UNIQUE(addr_id, port)
+);
+
+CREATE INDEX IF NOT EXISTS idx_hub_ts ON hub(ts);
+
+CREATE TABLE IF NOT EXISTS hub_info( 
+    hub_id INTEGER PRIMARY KEY REFERENCES hub(hub_id),
+    version TEXT, 
+    is_syncing BOOL, 
+    nickname TEXT, 
+    root_hash TEXT, 
+    peerid TEXT, 
+    fid INTEGER, 
+    num_messages INTEGER, 
+    num_fid_events INTEGER, 
+    num_fname_events INTEGER, 
+    approx_size INTEGER,
+    updated_at INTEGER NOT NULL DEFAULT (unixepoch())
+);
+
+CREATE INDEX IF NOT EXISTS idx_hub_info_updated_at ON hub_info(updated_at);
+
+CREATE TABLE IF NOT EXISTS scan_stats (
+    ts INTEGER NOT NULL DEFAULT (unixepoch()),
+    hubs INTEGER DEFAULT 0,
+    queried INTEGER DEFAULT 0,
+    unreachable INTEGER DEFAULT 0,
+    stop_reason TEXT
+);
+
+-- Transport that last worked for a hub address (ip:port or dnsname:port).
+CREATE TABLE IF NOT EXISTS transport (
+    address TEXT NOT NULL PRIMARY KEY,
+    use_ssl BOOL NOT NULL,
+    updated_at INTEGER NOT NULL
+);
+
+-- Consecutive failed calls to a hub address and when to try it again.
+CREATE TABLE IF NOT EXISTS hub_failure (
+    address TEXT NOT NULL PRIMARY KEY,
+    failures INTEGER NOT NULL,
+    last_code TEXT,
+    next_retry INTEGER NOT NULL
+);
+
+-- Durations (ms, comma separated, oldest first) of the last successful calls to a hub address.
+CREATE TABLE IF NOT EXISTS hub_latency (
+    address TEXT NOT NULL PRIMARY KEY,
+    samples TEXT NOT NULL
+);
+
+-- One row per gRPC call, appended by every command that talks to hubs.
+-- method is a RPC_METHODS value, status a grpc.StatusCode value (0 is OK).
+CREATE TABLE IF NOT EXISTS rpc_log (
+    ts INTEGER NOT NULL,
+    hub_id INTEGER NOT NULL,
+    method INTEGER NOT NULL,
+    tls BOOL NOT NULL,
+    status INTEGER NOT NULL,
+    ms INTEGER NOT NULL,
+    size INTEGER
+);
+
+CREATE INDEX IF NOT EXISTS idx_rpc_log_ts ON rpc_log(ts);
+
+-- Hub src (a hub_id) listed hub dst in its GetCurrentPeers response, last seen at ts (epoch seconds).
+CREATE TABLE IF NOT EXISTS edge (
+    src INTEGER NOT NULL,
+    dst INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    PRIMARY KEY (src, dst)
+) WITHOUT ROWID;
+"""
+
+# rpc_log.method of each logged gRPC method.
+RPC_METHODS = {'GetCurrentPeers': 1, 'GetInfo': 2}
+
+# Timestamp columns that used to be TEXT (datetime()) and are INTEGER epoch seconds
+# since migration 3.
+EPOCH_COLUMNS = [
+    ('hub', 'ts'),
+    ('hub_info', 'updated_at'),
+    ('addr', 'updated_at'),
+    ('scan_stats', 'ts'),
+]
+
+# Columns added to scan_stats after it was first released (migration 1).
+ADDED_COLUMNS = [
+    ('scan_stats', 'queried', 'INTEGER DEFAULT 0'),
+    ('scan_stats', 'unreachable', 'INTEGER DEFAULT 0'),
+    ('scan_stats', 'stop_reason', 'TEXT'),
+]
+
+def pack_ip(ip):
+    """4 (IPv4) or 16 (IPv6) byte form of an IP address, None if `ip` is not one."""
+    try:
+        return ip_address(ip.strip('[]')).packed
+    except ValueError:
+        return None
+
+def unpack_ip(packed):
+    return str(ip_address(packed))
+
+def intern_hubs(conn, addresses):
+    """{address: hub_id} for 'ip:port' `addresses`, adding hub rows for new ones.
+
+    Addresses that are not an IP and a port are left out.
+    """
+    keys = {}
+    for address in addresses:
+        (ip, _, port) = address.rpartition(':')
+        packed = pack_ip(ip)
+        if packed is not None and port.isdigit():
+            keys[address] = (packed, int(port))
+    conn.executemany("""INSERT OR IGNORE INTO addr (ip) VALUES (?)""", {(ip,) for ip, _ in keys.values()})
+    conn.executemany("""
+        INSERT OR IGNORE INTO hub (addr_id, port) SELECT addr_id, ? FROM addr WHERE ip = ?
+        """, ((port, ip) for ip, port in keys.values()))
+    return {
+        address: conn.execute("""
+            SELECT hub.hub_id FROM hub JOIN addr ON addr.addr_id = hub.addr_id WHERE addr.ip = ? AND hub.port = ?
+            """, key).fetchone()[0]
+        for address, key in keys.items()
+    }
+
+def _columns(conn, table):
+    return [r[1] for r in conn.execute(f'PRAGMA table_info({table})')]
+
+def _column_type(conn, table, column):
+    return next((r[2] for r in conn.execute(f'PRAGMA table_info({table})') if r[1] == column), None)
+
+def _create_tables(conn):
+    # executescript() would commit, so migrations create tables statement by statement.
+    for statement in SCHEMA.split(';'):
+        conn.execute(statement)
+
+# Migrations run inside a transaction opened by migrate(), with
+# legacy_alter_table on so renaming a table leaves references to it alone.
+# Databases from before SCHEMA_VERSION existed start at version 0, so every
+# migration checks whether its change is still needed.
+
+def _add_scan_stats_columns(conn):
+    if not _columns(conn, 'scan_stats'):
+        return
+    for table, column, decl in ADDED_COLUMNS:
+        if column not in _columns(conn, table):
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
+
+def _migrate_hub_ids(conn):
+    """Move hub, hub_info and addr from (ip TEXT, port) keys to integer ids and packed IPs."""
+    if 'ip' not in _columns(conn, 'hub'):
+        return
+    conn.create_function('pack_ip', 1, pack_ip, deterministic=True)
+    for table in ('hub', 'hub_info', 'addr'):
+        if _columns(conn, table):
+            conn.execute(f'ALTER TABLE {table} RENAME TO old_{table}')
+    conn.execute('DROP INDEX IF EXISTS idx_hub_ip')
+    _create_tables(conn)
+    conn.execute("""
+        INSERT OR IGNORE INTO addr (ip, country_code, country_name, region_name, city_name, latitude, longitude, zip_code, time_zone, as_number, as_name, is_proxy, updated_at)
+        SELECT pack_ip(ip), country_code, country_name, region_name, city_name, latitude, longitude, zip_code, time_zone, as_number, as_name, is_proxy, unixepoch(updated_at)
+        FROM old_addr WHERE pack_ip(ip) IS NOT NULL
+        """)
+    conn.execute("""INSERT OR IGNORE INTO addr (ip) SELECT pack_ip(ip) FROM old_hub WHERE pack_ip(ip) IS NOT NULL""")
+    conn.execute("""
+        INSERT OR IGNORE INTO hub (addr_id, port, dnsname, proto_version, app_version, ts)
+        SELECT addr.addr_id, old_hub.port, old_hub.dnsname, old_hub.proto_version, old_hub.app_version, unixepoch(old_hub.ts)
+        FROM old_hub JOIN addr ON addr.ip = pack_ip(old_hub.ip)
+        """)
+    conn.execute("""
+        INSERT OR IGNORE INTO hub_info (hub_id, version, is_syncing, nickname, root_hash, peerid, fid, num_messages, num_fid_events, num_fname_events, approx_size, updated_at)
+        SELECT hub.hub_id, old.version, old.is_syncing, old.nickname, old.root_hash, old.peerid, old.fid, old.num_messages, old.num_fid_events, old.num_fname_events, old.approx_size, coalesce(unixepoch(old.updated_at), 0)
+        FROM old_hub_info AS old
+        JOIN addr ON addr.ip = pack_ip(old.ip)
+        JOIN hub ON hub.addr_id = addr.addr_id AND hub.port = old.port
+        """)
+    if _columns(conn, 'hub_key'):
+        # Edges used to reference their own address table.
+        keys = dict(conn.execute("""SELECT id, address FROM hub_key"""))
+        ids = intern_hubs(conn, keys.values())
+        edges = conn.execute("""SELECT src, dst, ts FROM edge""").fetchall()
+        conn.execute("""DELETE FROM edge""")
+        conn.executemany("""
+            INSERT OR IGNORE INTO edge (src, dst, ts) VALUES (?,?,?)
+            """, [(ids[keys[s]], ids[keys[d]], ts) for s, d, ts in edges if keys[s] in ids and keys[d] in ids])
+        conn.execute("""DROP TABLE hub_key""")
+    for table in ('hub', 'hub_info', 'addr'):
+        conn.execute(f'DROP TABLE IF EXISTS old_{table}')
+
+def _migrate_epoch_timestamps(conn):
+    """Rebuild the tables in EPOCH_COLUMNS whose timestamp is still TEXT, converting it with unixepoch()."""
+    tables = [(t, c) for t, c in EPOCH_COLUMNS if _column_type(conn, t, c) == 'TEXT']
+    if not tables:
+        return
+    # A TEXT column would turn the epoch values back into strings, so the tables are rebuilt.
+    for table, _ in tables:
+        conn.execute(f'ALTER TABLE {table} RENAME TO old_{table}')
+    _create_tables(conn)
+    for table, column in tables:
+        columns = _columns(conn, f'old_{table}')
+        not_null = any(r[1] == column and r[3] for r in conn.execute(f'PRAGMA table_info({table})'))
+        epoch = f'coalesce(unixepoch({column}), 0)' if not_null else f'unixepoch({column})'
+        values = [epoch if c == column else c for c in columns]
+        conn.execute(f'INSERT INTO {table} ({", ".join(columns)}) SELECT {", ".join(values)} FROM old_{table}')
+        conn.execute(f'DROP TABLE old_{table}')
+
+def _compact_rpc_log(conn):
+    """Key rpc_log by hub_id and store method and status as integers."""
+    if 'address' not in _columns(conn, 'rpc_log'):
+        return
+    conn.execute('ALTER TABLE rpc_log RENAME TO old_rpc_log')
+    # The index moved with the table and would stop the new one from getting its own.
+    conn.execute('DROP INDEX IF EXISTS idx_rpc_log_ts')
+    _create_tables(conn)
+    addresses = [r[0] for r in conn.execute("""SELECT DISTINCT address FROM old_rpc_log""")]
+    ids = intern_hubs(conn, addresses)
+    statuses = {code.name: code.value[0] for code in grpc.StatusCode}
+    rows = conn.execute("""SELECT ts, address, method, tls, status, ms, size FROM old_rpc_log""").fetchall()
+    # Calls to hubs known only by hostname, like the seed hub, have no hub_id and are dropped.
+    conn.executemany("""
+        INSERT INTO rpc_log (ts, hub_id, method, tls, status, ms, size) VALUES (?,?,?,?,?,?,?)
+        """, [(ts, ids[address], RPC_METHODS.get(method, 0), tls, statuses.get(status, grpc.StatusCode.UNKNOWN.value[0]), ms, size)
+              for ts, address, method, tls, status, ms, size in rows if address in ids])
+    conn.execute('DROP TABLE old_rpc_log')
+
+# (version, description, function). Append only; SCHEMA always describes the latest version.
+MIGRATIONS = [
+    (1, 'Add queried, unreachable and stop_reason to scan_stats', _add_scan_stats_columns),
+    (2, 'Key hub, hub_info and addr by integer ids, store IPs packed', _migrate_hub_ids),
+    (3, 'Store timestamps as INTEGER epoch seconds', _migrate_epoch_timestamps),
+    (4, 'Key rpc_log by hub_id, store method and status as integers', _compact_rpc_log),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def schema_version(conn):
+    """The SCHEMA_VERSION recorded in kv, None if there is none."""
+    if not _columns(conn, 'kv'):
+        return None
+    row = conn.execute("""SELECT v FROM kv WHERE k = 'SCHEMA_VERSION'""").fetchone()
+    return row[0] if row else None
+
+def _set_version(conn, version):
+    conn.execute("""CREATE TABLE IF NOT EXISTS kv(k TEXT NOT NULL PRIMARY KEY, v INTEGER)""")
+    conn.execute("""INSERT OR REPLACE INTO kv VALUES ('SCHEMA_VERSION', ?)""", (version,))
+
+def pending_migrations(conn):
+    version = schema_version(conn)
+    if version is None:
+        if not _columns(conn, 'hub'):
+            # A new database gets the current SCHEMA directly.
+            return []
+        version = 0
+    return [m for m in MIGRATIONS if m[0] > version]
+
+class _Explain:
+    """Connection wrapper that records every statement, and its query plan, before running it."""
+    def __init__(self, conn):
+        self._conn = conn
+        self.statements = []
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def _record(self, sql, params, rows=1):
+        statement = ' '.join(line for line in sql.split('\n') if not line.strip().startswith('--'))
+        statement = ' '.join(statement.split())
+        if not statement or statement.upper().startswith('PRAGMA'):
+            return
+        plan = []
+        if params is not None and statement.upper().startswith(('INSERT', 'UPDATE', 'DELETE', 'SELECT')):
+            plan = [r[3] for r in self._conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+        self.statements.append((statement, plan, rows))
+
+    def execute(self, sql, params=()):
+        self._record(sql, params)
+        return self._conn.execute(sql, params)
+
+    def executemany(self, sql, rows):
+        rows = list(rows)
+        self._record(sql, rows[0] if rows else None, len(rows))
+        return self._conn.executemany(sql, rows)
+
+def migrate(conn, dry_run=False, explain=False):
+    """Apply the pending migrations in order, each in its own transaction.
+
+    With `dry_run` they all run in one transaction that is rolled back.
+    Returns (version, description, seconds, statements) per migration;
+    with `explain`, statements lists every (sql, query plan, rows) it ran.
+    """
+    pending = pending_migrations(conn)
+    results = []
+    if not pending:
+        return results
+    conn.commit()
+    conn.execute('PRAGMA legacy_alter_table = ON')
+    try:
+        if dry_run:
+            conn.execute('BEGIN')
+        for version, description, step in pending:
+            target = _Explain(conn) if explain else conn
+            if not dry_run:
+                conn.execute('BEGIN')
+            started = time.perf_counter()
+            try:
+                step(target)
+                _set_version(conn, version)
+            except:
+                conn.rollback()
+                raise
+            seconds = time.perf_counter() - started
+            if not dry_run:
+                conn.commit()
+            results.append((version, description, seconds, target.statements if explain else []))
+        if dry_run:
+            conn.rollback()
+    finally:
+        conn.execute('PRAGMA legacy_alter_table = OFF')
+    return results
+
+def create_schema(conn):
+    """Apply pending migrations, then create missing tables. Safe to run on an existing database."""
+    migrate(conn)
+    conn.executescript(SCHEMA)
+    if schema_version(conn) is None:
+        _set_version(conn, SCHEMA_VERSION)
+    conn.commit()
@@ -0,0 +1,191 @@
+"""Offline stand-in for the Farcaster network, for tests and benchmarks.
+
+A Topology is a synthetic network of hubs, each with a peer list and a
+behaviour: latency, TLS-only, hanging until the client deadline, or dead.
+HubSimulator serves it with one grpc.aio HubService server per hub on
+loopback ports, all driven by one event loop in a background thread.
+Large topologies need one file descriptor per hub (see `ulimit -n`).
+"""
+import asyncio
+import os
+import random
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+import grpc
+
+from . GrpcClient import set_root_certificates
+from . fcproto import rpc_pb2_grpc
+from . fcproto.gossip_pb2 import ContactInfoContentBody, GossipAddressInfo
+from . fcproto.request_response_pb2 import ContactInfoResponse, DbStats, HubInfoResponse
+
+# How long a hanging hub sleeps; the client deadline always expires first.
+HANG_SECONDS = 3600
+
+class SimHub:
+    def __init__(self, index, latency=0.0, tls_only=False, hangs=False, dead=False):
+        self.index = index
+        self.latency = latency
+        self.tls_only = tls_only
+        self.hangs = hangs
+        self.dead = dead
+        self.peers = []
+        self.port = None
+
+class Topology:
+    """`size` hubs, each listing `degree` random peers plus the next hub on a ring.
+
+    Every hub gets a latency drawn uniformly from [0, 2 * `latency`] seconds.
+    The `tls_only`, `timeouts` and `dead` fractions of hubs only accept TLS,
+    never answer, or have nothing listening. Hub 0, the seed, is always a
+    healthy plaintext hub.
+    """
+    def __init__(self, size=100, degree=8, latency=0.0, tls_only=0.0, timeouts=0.0, dead=0.0, seed=None):
+        rnd = random.Random(seed)
+        self.hubs = [
+            SimHub(i,
+                latency=rnd.uniform(0, 2 * latency),
+                tls_only=i > 0 and rnd.random() < tls_only,
+                hangs=i > 0 and rnd.random() < timeouts,
+                dead=i > 0 and rnd.random() < dead)
+            for i in range(size)
+        ]
+        for hub in self.hubs:
+            peers = {(hub.index + 1) % size}
+            peers.update(rnd.sample(range(size), min(degree, size)))
+            peers.discard(hub.index)
+            hub.peers = sorted(peers)
+
+    def __len__(self):
+        return len(self.hubs)
+
+    def alive(self):
+        return [h for h in self.hubs if not h.dead and not h.hangs]
+
+class _SimHubServicer(rpc_pb2_grpc.HubServiceServicer):
+    def __init__(self, simulator, hub):
+        self._simulator = simulator
+        self._hub = hub
+
+    async def _delay(self):
+        if self._hub.hangs:
+            await asyncio.sleep(HANG_SECONDS)
+        if self._hub.latency:
+            await asyncio.sleep(self._hub.latency)
+
+    async def GetCurrentPeers(self, request, context):
+        await self._delay()
+        hubs = self._simulator.topology.hubs
+        now = int(time.time() * 1000)
+        return ContactInfoResponse(contacts=[
+            ContactInfoContentBody(
+                rpc_address=GossipAddressInfo(
+                    address=self._simulator.host,
+                    family=4,
+                    port=hubs[i].port,
+                    dns_name='localhost' if hubs[i].tls_only else ''),
+                hub_version='2024.9.4',
+                app_version='1.15.6',
+                timestamp=now)
+            for i in self._hub.peers
+        ])
+
+    async def GetInfo(self, request, context):
+        await self._delay()
+        return HubInfoResponse(
+            version='1.15.6',
+            is_syncing=False,
+            nickname=f'sim-{self._hub.index}',
+            root_hash='',
+            peerId=f'sim-peer-{self._hub.index}',
+            hub_operator_fid=self._hub.index,
+            db_stats=DbStats(num_messages=1000, num_fid_events=10, num_fname_events=10, approx_size=100000) if request.db_stats else None)
+
+class HubSimulator:
+    """Serve a Topology on loopback ports. Use as a context manager."""
+    def __init__(self, topology, host='127.0.0.1'):
+        self.topology = topology
+        self.host = host
+        self.certificate = None
+        self._previous_roots = None
+        self._servers = []
+        self._closed = []
+        self._loop = None
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def address(self, index=0):
+        return f'{self.host}:{self.topology.hubs[index].port}'
+
+    def start(self):
+        if any(h.tls_only for h in self.topology.hubs):
+            self.certificate, self._key = _self_signed_certificate(self.host)
+            self._previous_roots = set_root_certificates(self.certificate)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        if self.certificate:
+            set_root_certificates(self._previous_roots)
+
+    async def _start(self):
+        for hub in self.topology.hubs:
+            if hub.dead:
+                closed = _closed_port(self.host)
+                hub.port = closed.getsockname()[1]
+                self._closed.append(closed)
+                continue
+            server = grpc.aio.server()
+            rpc_pb2_grpc.add_HubServiceServicer_to_server(_SimHubServicer(self, hub), server)
+            if hub.tls_only:
+                credentials = grpc.ssl_server_credentials([(self._key, self.certificate)])
+                hub.port = server.add_secure_port(f'{self.host}:0', credentials)
+            else:
+                hub.port = server.add_insecure_port(f'{self.host}:0')
+            await server.start()
+            self._servers.append(server)
+
+    async def _stop(self):
+        await asyncio.gather(*(s.stop(None) for s in self._servers))
+        self._servers = []
+        for closed in self._closed:
+            closed.close()
+        self._closed = []
+
+def _closed_port(host):
+    """A socket bound to a port but not listening, so connecting to it fails right away.
+
+    Keeping it open until the simulator stops keeps other hubs, and other
+    simulators, off the port.
+    """
+    s = socket.socket()
+    s.bind((host, 0))
+    return s
+
+def _self_signed_certificate(host):
+    """(certificate, key) PEM bytes for localhost and `host`, made with the openssl CLI."""
+    with tempfile.TemporaryDirectory() as tmp:
+        cert = os.path.join(tmp, 'cert.pem')
+        key = os.path.join(tmp, 'key.pem')
+        subprocess.run([
+            'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+            '-keyout', key, '-out', cert, '-subj', '/CN=localhost',
+            '-addext', f'subjectAltName=DNS:localhost,IP:{host}',
+            ], check=True, capture_output=True)
+        with open(cert, 'rb') as f_cert, open(key, 'rb') as f_key:
+            return f_cert.read(), f_key.read()
@@ -0,0 +1,26 @@
+# SPDX-FileCopyrightText: 2024-present Panayotis Vryonis <vrypan@gmail.comm>
+#
+# SPDX-License-Identifier: MIT
+import gzip
+
+import pytest
+
+from fc_nmap import archive, get_hubs
+from fc_nmap.simulator import HubSimulator, Topology
+
+def test_ingest_matches_scan(tmp_path):
+    with HubSimulator(Topology(30, degree=4, dead=0.1, seed=4)) as simulator, \
+            archive.ArchiveWriter(tmp_path, scan_id='test', segment_records=5) as writer:
+        hubs = get_hubs.get_hubs_bfs(simulator.address(), {}, 100, timeout=2, on_peers=writer.add)
+    assert len(writer.paths) > 1
+    records = [r for path in writer.paths for r in archive.read_segment(path)]
+    assert len(records) == writer.records
+    assert {r[0] for r in records} == {'test'}
+    assert archive.ingest([tmp_path], processes=2) == (hubs, writer.records)
+
+def test_not_a_segment(tmp_path):
+    path = tmp_path / 'x.seg.gz'
+    with gzip.open(path, 'wb') as f:
+        f.write(b'hello')
+    with pytest.raises(ValueError):
+        list(archive.read_segment(path))
@@ -0,0 +1,16 @@
+# SPDX-FileCopyrightText: 2024-present Panayotis Vryonis <vrypan@gmail.comm>
+#
+# SPDX-License-Identifier: MIT
+from fc_nmap import bench
+
+def test_export_bench():
+    report = bench.run([50], ['export'])
+    assert {r['name'] for r in report['results']} == {e.__name__ for e in bench.EXPORTS}
+    assert bench.compare(report, report) == []
+    slower = {'results': [dict(r, rate=r['rate'] * 2) for r in report['results']]}
+    assert len(bench.compare(report, slower)) == len(report['results'])
+
+def test_probe_bench():
+    (result,) = bench.bench_probe(20, workers=4)
+    assert (result['name'], result['size']) == ('probe-4', 20)
+    assert result['rate'] > 0
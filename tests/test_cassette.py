@@ -0,0 +1,102 @@
+# SPDX-FileCopyrightText: 2024-present Panayotis Vryonis <vrypan@gmail.comm>
+#
+# SPDX-License-Identifier: MIT
+import asyncio
+import logging
+import time
+
+import grpc
+import pytest
+from click.testing import CliRunner
+
+from fc_nmap import db, get_hubs
+from fc_nmap.cli import fc_nmap
+from fc_nmap.cassette import Cassette
+from fc_nmap.GrpcClient import HubService, use_cassette
+from fc_nmap.simulator import HubSimulator, Topology
+
+def _record(path, crawl):
+    cassette = Cassette(path, 'record')
+    use_cassette(cassette)
+    try:
+        return crawl()
+    finally:
+        use_cassette(None)
+        cassette.close()
+
+def _replay(path, crawl):
+    use_cassette(Cassette(path, 'replay'))
+    try:
+        return crawl()
+    finally:
+        use_cassette(None)
+
+def test_replay_bfs_without_network(tmp_path):
+    path = tmp_path / 'scan.jsonl'
+    with HubSimulator(Topology(20, degree=4, dead=0.1, seed=2)) as simulator:
+        seed = simulator.address()
+        crawl = lambda: get_hubs.get_hubs_bfs(seed, {}, 100, timeout=2)
+        recorded = _record(path, crawl)
+    # The simulator is gone; every answer and every failure comes from the cassette.
+    assert _replay(path, crawl) == recorded
+
+def test_replay_concurrent_and_race(tmp_path):
+    path = tmp_path / 'probe.jsonl'
+    with HubSimulator(Topology(10, degree=3, seed=3)) as simulator:
+        seed = simulator.address()
+        crawl = lambda: asyncio.run(get_hubs.get_hubs_concurrent(seed, {}, 100, concurrency=4, timeout=2, mode='bfs'))
+        probe = lambda: get_hubs.get_hub_info('127.0.0.1', simulator.topology.hubs[1].port, 'localhost', timeout=2, race=True, allow_private=True)
+        recorded = _record(path, lambda: (crawl(), probe()))
+    replayed = _replay(path, lambda: (crawl(), probe()))
+    assert replayed[0] == recorded[0]
+    assert replayed[1].nickname == 'sim-1'
+
+def test_unknown_call(tmp_path):
+    path = tmp_path / 'empty.jsonl'
+    path.write_text('')
+    with pytest.raises(grpc.RpcError) as e:
+        _replay(path, lambda: HubService('127.0.0.1:1').GetInfo())
+    assert e.value.code() == grpc.StatusCode.UNAVAILABLE
+
+def test_call_ending_after_close(tmp_path, caplog):
+    path = tmp_path / 'race.jsonl'
+    topology = Topology(2, degree=1, seed=4)
+    topology.hubs[1].hangs = True
+    with HubSimulator(topology) as simulator:
+        cassette = Cassette(path, 'record')
+        use_cassette(cassette)
+        try:
+            hub = HubService(simulator.address(1))
+            call = hub.GetInfoFuture(timeout=5)
+        finally:
+            use_cassette(None)
+            cassette.close()
+        # The loser of a race is cancelled after the command closed its cassette.
+        with caplog.at_level(logging.ERROR):
+            call.cancel()
+            time.sleep(0.2)
+        hub.close()
+    assert call.code() == grpc.StatusCode.CANCELLED
+    assert not [r for r in caplog.records if r.levelno >= logging.ERROR]
+    assert path.read_text() == ''
+
+def test_replayed_scans_leave_hub_state_alone(tmp_path):
+    path = str(tmp_path / 'hubs.db')
+    cassette = str(tmp_path / 'scan.jsonl')
+    scan = lambda seed, *args: CliRunner().invoke(fc_nmap, ['--db', path, 'scan', '--hub', seed, '--mode', 'bfs', '--hops', '1000', '--timeout', '2', *args])
+    with HubSimulator(Topology(20, degree=4, dead=0.2, seed=2)) as simulator:
+        seed = simulator.address()
+        recorded = scan(seed, '--record', cassette)
+    assert recorded.exit_code == 0, recorded.output
+    conn = db.connect(path)
+    state = lambda: [conn.execute(f"""SELECT * FROM {table} ORDER BY 1""").fetchall() for table in ('rpc_log', 'hub_latency', 'hub_failure', 'transport')]
+    before = state()
+    for _ in range(3):
+        replayed = scan(seed, '--replay', cassette)
+        assert replayed.exit_code == 0, replayed.output
+        # The dead hubs failed twice by now, but the replay does not see the live circuit breaker.
+        assert f'Hubs queried: {len(simulator.topology)},' in replayed.output
+    assert state() == before
+    result = CliRunner().invoke(fc_nmap, ['--db', path, 'scan', '--hub', seed, '--replay', cassette])
+    assert result.exit_code == 2
+    assert '--mode bfs' in result.output
@@ -0,0 +1,74 @@
+# SPDX-FileCopyrightText: 2024-present Panayotis Vryonis <vrypan@gmail.comm>
+#
+# SPDX-License-Identifier: MIT
+import subprocess
+import sys
+import time
+
+import click
+import pytest
+
+from fc_nmap import GrpcClient
+from fc_nmap.GrpcClient import ChannelPool
+
+def test_reuse():
+    pool = ChannelPool()
+    channel = pool.get('127.0.0.1:2283')
+    assert pool.get('127.0.0.1:2283') is channel
+    assert pool.get('127.0.0.1:2283', use_ssl=True) is not channel
+    pool.close()
+    assert len(pool) == 0
+
+def _use(pool, address):
+    """Check out the channel to `address` and give it back, like a finished call."""
+    channel = pool.get(address)
+    pool.release(address)
+    return channel
+
+def test_max_size():
+    pool = ChannelPool(max_size=2)
+    first = _use(pool, '127.0.0.1:1')
+    _use(pool, '127.0.0.1:2')
+    _use(pool, '127.0.0.1:1')
+    _use(pool, '127.0.0.1:3')
+    assert len(pool) == 2
+    assert _use(pool, '127.0.0.1:1') is first
+    pool.close()
+
+def test_ttl():
+    pool = ChannelPool(ttl=0.01)
+    channel = _use(pool, '127.0.0.1:1')
+    time.sleep(0.02)
+    assert _use(pool, '127.0.0.1:1') is not channel
+    assert len(pool) == 1
+    pool.close()
+
+def test_busy_channels_stay_open():
+    pool = ChannelPool(max_size=2, ttl=0.01)
+    busy = [pool.get(f'127.0.0.1:{port}') for port in (1, 2, 3)]
+    time.sleep(0.02)
+    # Over max_size and past the ttl, but every channel has a call in flight.
+    assert len(pool) == 3
+    assert pool.get('127.0.0.1:1') is busy[0]
+    pool.release('127.0.0.1:1')
+    for port in (1, 2, 3):
+        pool.release(f'127.0.0.1:{port}')
+    # Idle now: the pool shrinks back to max_size, then the expired channels go.
+    assert len(pool) == 2
+    time.sleep(0.02)
+    _use(pool, '127.0.0.1:4')
+    assert len(pool) == 1
+    pool.close()
+
+def test_missing_ssl_roots(tmp_path, monkeypatch):
+    missing = str(tmp_path / 'missing.pem')
+    monkeypatch.setenv('FCNMAP_SSL_ROOTS', missing)
+    # Importing fc-nmap and plaintext channels do not need the file.
+    subprocess.run([sys.executable, '-c', 'import fc_nmap.cli'], check=True)
+    pool = ChannelPool()
+    pool.get('127.0.0.1:1')
+    with pytest.raises(click.FileError, match='FCNMAP_SSL_ROOTS'):
+        pool.get('127.0.0.1:1', use_ssl=True)
+    pool.close()
+    (tmp_path / 'missing.pem').write_bytes(b'PEM')
+    assert GrpcClient.root_certificates() == b'PEM'
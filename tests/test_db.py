@@ -0,0 +1,64 @@
+# SPDX-FileCopyrightText: 2024-present Panayotis Vryonis <vrypan@gmail.comm>
+#
+# SPDX-License-Identifier: MIT
+import sqlite3
+import time
+
+import pytest
+
+from fc_nmap import db, dbexports
+
+def test_wal_and_readonly(tmp_path):
+    path = str(tmp_path / 'hubs.db')
+    writer = db.connect(path)
+    assert writer.execute('PRAGMA journal_mode').fetchone() == ('wal',)
+    assert writer.execute('PRAGMA synchronous').fetchone() == (1,)  # NORMAL
+    writer.execute("""INSERT INTO kv VALUES ('LAST_SCAN', 1)""")
+    # An open write transaction does not keep readers out.
+    reader = db.connect(path, readonly=True)
+    assert reader.execute("""SELECT COUNT(*) FROM kv WHERE k = 'LAST_SCAN'""").fetchone() == (0,)
+    with pytest.raises(sqlite3.OperationalError):
+        reader.execute("""DELETE FROM kv""")
+    writer.commit()
+    assert reader.execute("""SELECT COUNT(*) FROM kv WHERE k = 'LAST_SCAN'""").fetchone() == (1,)
+
+def test_set_path(tmp_path):
+    path = str(tmp_path / 'other.db')
+    previous = db.set_path(path)
+    try:
+        db.connect().close()
+        dbexports.export_app_version(out=str(tmp_path / 'out.tsv'))
+    finally:
+        assert db.set_path(previous) == path
+    assert (tmp_path / 'other.db').exists()
+
+def test_writer_batches(tmp_path):
+    path = str(tmp_path / 'hubs.db')
+    reader = db.connect(path)
+    with db.DbWriter(path, batch_size=10, batch_seconds=60) as writer:
+        writer.executemany("""INSERT INTO kv VALUES (?, 1)""", [(f'k{i}',) for i in range(25)])
+        # Two full batches are committed; the last 5 rows wait for the size, the timer or close.
+        while writer.commits < 2:
+            time.sleep(0.01)
+        assert reader.execute("""SELECT COUNT(*) FROM kv WHERE v = 1""").fetchone() == (20,)
+        writer.call(lambda conn: conn.execute("""DELETE FROM kv WHERE k = 'k0'"""))
+        writer.flush()
+        assert reader.execute("""SELECT COUNT(*) FROM kv WHERE v = 1""").fetchone() == (24,)
+        writer.execute("""INSERT INTO kv VALUES ('last', 1)""")
+    assert reader.execute("""SELECT COUNT(*) FROM kv WHERE v = 1""").fetchone() == (25,)
+    assert writer.rows == 26
+
+def test_writer_batch_seconds(tmp_path):
+    path = str(tmp_path / 'hubs.db')
+    reader = db.connect(path)
+    with db.DbWriter(path, batch_size=1000, batch_seconds=0.1) as writer:
+        writer.execute("""INSERT INTO kv VALUES ('a', 1)""")
+        time.sleep(0.5)
+        assert reader.execute("""SELECT COUNT(*) FROM kv WHERE v = 1""").fetchone() == (1,)
+
+def test_writer_error(tmp_path):
+    path = str(tmp_path / 'hubs.db')
+    writer = db.DbWriter(path)
+    writer.execute("""INSERT INTO no_such_table VALUES (1)""")
+    with pytest.raises(sqlite3.OperationalError):
+        writer.close()
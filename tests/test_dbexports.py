@@ -0,0 +1,60 @@
+# SPDX-FileCopyrightText: 2024-present Panayotis Vryonis <vrypan@gmail.comm>
+#
+# SPDX-License-Identifier: MIT
+import time
+
+from fc_nmap import bench, db, dbexports
+from fc_nmap.schema import RPC_METHODS, intern_hubs
+
+def test_export_full_streams(tmp_path, monkeypatch):
+    path = str(tmp_path / 'hubs.db')
+    bench.populate_db(path, 50)
+    monkeypatch.setattr(dbexports, 'FETCH_SIZE', 7)
+    out = tmp_path / 'full.tsv'
+    dbexports.export_full(dbpath=path, out=str(out))
+    lines = out.read_text().splitlines()
+    assert len(lines) == 50
+    assert len({line.split('\t')[0] for line in lines}) == 50
+    assert any(line.startswith('10.0.0.0\t2283\t') for line in lines)
+
+def test_export_reports_match_single_exports(tmp_path):
+    path = str(tmp_path / 'hubs.db')
+    bench.populate_db(path, 300)
+    paths = dbexports.export_reports(dbexports.REPORTS, str(tmp_path), dbpath=path)
+    assert paths == [str(tmp_path / f'{report}.tsv') for report in dbexports.REPORTS]
+    singles = {
+        'all': dbexports.export_full,
+        'countries': dbexports.export_countries,
+        'fids': dbexports.export_fids,
+        'app': dbexports.export_app_version,
+        'asn': dbexports.export_asn,
+        'geoip': dbexports.export_latlong,
+    }
+    for report, export in singles.items():
+        out = tmp_path / f'{report}.single'
+        export(dbpath=path, out=str(out))
+        assert (tmp_path / f'{report}.tsv').read_text() == out.read_text(), report
+
+def test_export_latency_percentiles(tmp_path):
+    path = str(tmp_path / 'hubs.db')
+    conn = db.connect(path)
+    ids = intern_hubs(conn, ['1.2.3.4:2283', '5.6.7.8:2283'])
+    conn.execute("""UPDATE addr SET as_number = 24940, as_name = 'Hetzner Online GmbH'""")
+    now = int(time.time())
+    # Ten OK calls to 1.2.3.4 taking 10..100 ms and one UNAVAILABLE, three OK calls to 5.6.7.8.
+    rows = [(ids['1.2.3.4:2283'], 0, ms) for ms in range(10, 101, 10)] + [(ids['1.2.3.4:2283'], 14, 3)]
+    rows += [(ids['5.6.7.8:2283'], 0, ms) for ms in (7, 5, 9)]
+    conn.executemany("""
+        INSERT INTO rpc_log (ts, hub_id, method, tls, status, ms, size) VALUES (?,?,?,0,?,?,NULL)
+        """, [(now, hub_id, RPC_METHODS['GetInfo'], status, ms) for hub_id, status, ms in rows])
+    # Older than max_age.
+    conn.execute("""INSERT INTO rpc_log VALUES (?,?,?,0,0,1000,NULL)""", (now - 7200, ids['5.6.7.8:2283'], RPC_METHODS['GetInfo']))
+    conn.commit()
+    conn.close()
+    out = tmp_path / 'latency.tsv'
+    dbexports.export_latency(dbpath=path, out=str(out), max_age=3600)
+    assert out.read_text().splitlines() == [
+        'hub\t1.2.3.4:2283\t11\t1\t60\t100\t100',
+        'hub\t5.6.7.8:2283\t3\t0\t7\t9\t9',
+        'asn\t24940\tHetzner Online GmbH\t14\t1\t40\t90\t100',
+    ]
@@ -0,0 +1,44 @@
+# SPDX-FileCopyrightText: 2024-present Panayotis Vryonis <vrypan@gmail.comm>
+#
+# SPDX-License-Identifier: MIT
+import pytest
+
+from fc_nmap import geodb
+
+# ip2location DB5 layout: no header, integer addresses, '-' for unknown.
+DB5 = '''"0","16777215","-","-","-","-","0.000000","0.000000"
+"16777216","16777471","AU","Australia","Queensland","Brisbane","-27.467540","153.028090"
+"3232235520","3232301055","US","United States of America","California","San Jose","37.339390","-121.894960"
+"281470681743360","281470698520575","-","-","-","-","0.000000","0.000000"
+'''
+
+NETWORKS = '''network,country_code,country_name,latitude,longitude,asn,as
+2a01:4f8::/32,DE,Germany,51.2993,9.491,AS24940,Hetzner Online GmbH
+5.9.0.0/16,DE,Germany,51.2993,9.491,24940,Hetzner Online GmbH
+'''
+
+def test_db5(tmp_path):
+    (tmp_path / 'db5.csv').write_text(DB5)
+    assert geodb.compile_csv(tmp_path / 'db5.csv', tmp_path / 'geo.db') == (4, 3)
+    with geodb.GeoDB(tmp_path / 'geo.db') as geo:
+        info = geo.lookup('192.168.1.7')
+        assert (info['country_code'], info['city_name'], info['latitude'], info['asn']) == ('US', 'San Jose', 37.33939, None)
+        assert geo.lookup('1.0.0.0')['country_name'] == 'Australia'
+        assert geo.lookup('1.0.0.255')['country_name'] == 'Australia'
+        assert geo.lookup('1.0.1.0') is None
+        assert geo.lookup('0.0.0.1')['country_code'] is None
+        assert geo.lookup('not an ip') is None
+
+def test_networks(tmp_path):
+    (tmp_path / 'networks.csv').write_text(NETWORKS)
+    geodb.compile_csv(tmp_path / 'networks.csv', tmp_path / 'geo.db')
+    with geodb.GeoDB(tmp_path / 'geo.db') as geo:
+        assert geo.lookup('2a01:4f8:10a:1::2')['asn'] == '24940'
+        assert geo.lookup('5.9.80.1')['as'] == 'Hetzner Online GmbH'
+        assert geo.lookup('2a01:4f9::1') is None
+        assert geo.lookup('5.10.0.1') is None
+
+def test_not_a_geodb(tmp_path):
+    (tmp_path / 'x.db').write_bytes(b'hello world')
+    with pytest.raises(ValueError):
+        geodb.GeoDB(tmp_path / 'x.db')
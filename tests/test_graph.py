@@ -0,0 +1,39 @@
+# SPDX-FileCopyrightText: 2024-present Panayotis Vryonis <vrypan@gmail.comm>
+#
+# SPDX-License-Identifier: MIT
+import sqlite3
+import time
+from array import array
+
+from fc_nmap import graph
+from fc_nmap.fcproto.gossip_pb2 import ContactInfoContentBody, GossipAddressInfo
+from fc_nmap.fcproto.request_response_pb2 import ContactInfoResponse
+from fc_nmap.schema import create_schema
+
+def _graph(n, edges):
+    return graph.Graph([str(i) for i in range(n)], array('l', [e[0] for e in edges]), array('l', [e[1] for e in edges]))
+
+def test_components_and_bridges():
+    # Two triangles joined through node 3, plus a separate pair.
+    g = _graph(9, [(0, 1), (1, 2), (2, 0), (2, 3), (3, 4), (4, 5), (5, 6), (6, 4), (7, 8)])
+    assert [sorted(c) for c in graph.connected_components(g)] == [[0, 1, 2, 3, 4, 5, 6], [7, 8]]
+    assert graph.articulation_points(g) == {2, 3, 4}
+    assert graph.degree_distribution(g.out_degrees()) == {0: 1, 1: 7, 2: 1}
+
+def _peers(*ports):
+    return ContactInfoResponse(contacts=[ContactInfoContentBody(rpc_address=GossipAddressInfo(address='10.0.0.1', port=p)) for p in ports])
+
+def test_edges_roundtrip():
+    conn = sqlite3.connect(':memory:')
+    create_schema(conn)
+    edges = graph.EdgeRecorder()
+    edges.add('10.0.0.1:1', _peers(1, 2, 3))
+    edges.add('10.0.0.1:2', _peers(1))
+    assert len(edges) == 3
+    edges.save(conn, int(time.time()))
+    # A newer peer list replaces the observer's old edges.
+    edges.add('10.0.0.1:1', _peers(2))
+    edges.save(conn, int(time.time()))
+    g = graph.load_graph(conn)
+    assert sorted((g.addresses[s], g.addresses[d]) for s, d in zip(g.src, g.dst)) == [
+        ('10.0.0.1:1', '10.0.0.1:2'), ('10.0.0.1:2', '10.0.0.1:1')]
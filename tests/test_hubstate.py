@@ -0,0 +1,76 @@
+# SPDX-FileCopyrightText: 2024-present Panayotis Vryonis <vrypan@gmail.comm>
+#
+# SPDX-License-Identifier: MIT
+import sqlite3
+
+from grpc import StatusCode
+
+from fc_nmap import get_hubs
+from fc_nmap.hubstate import DEADLINE_FACTOR, DEADLINE_FLOOR, LATENCY_SAMPLES, HubState
+from fc_nmap.schema import create_schema
+from fc_nmap.simulator import HubSimulator, Topology
+
+def _db():
+    conn = sqlite3.connect(':memory:')
+    create_schema(conn)
+    return conn
+
+def test_transport_roundtrip():
+    conn = _db()
+    state = HubState(conn)
+    assert state.transport('1.2.3.4:2283') is None
+    state.set_transport('1.2.3.4:2283', True)
+    state.set_transport('5.6.7.8:2283', False)
+    state.save(conn)
+    state = HubState(conn)
+    assert state.transport('1.2.3.4:2283') is True
+    assert state.transport('5.6.7.8:2283') is False
+
+def test_transport_expires():
+    conn = _db()
+    conn.execute("INSERT INTO transport VALUES ('1.2.3.4:2283', 1, 0)")
+    assert HubState(conn).transport('1.2.3.4:2283') is None
+
+def test_circuit_breaker():
+    conn = _db()
+    state = HubState(conn)
+    state.record_failure('1.2.3.4:2283', StatusCode.UNAVAILABLE)
+    assert not state.is_open('1.2.3.4:2283')
+    state.record_failure('1.2.3.4:2283', StatusCode.DEADLINE_EXCEEDED)
+    assert state.is_open('1.2.3.4:2283')
+    state.save(conn)
+    assert conn.execute("SELECT failures, last_code FROM hub_failure").fetchone() == (2, 'DEADLINE_EXCEEDED')
+    state = HubState(conn)
+    assert state.is_open('1.2.3.4:2283')
+    state.record_success('1.2.3.4:2283')
+    assert not state.is_open('1.2.3.4:2283')
+    state.save(conn)
+    assert conn.execute("SELECT COUNT(*) FROM hub_failure").fetchone()[0] == 0
+
+def test_deadline():
+    conn = _db()
+    state = HubState(conn)
+    assert state.deadline('1.2.3.4:2283', 5) == 5
+    for seconds in (0.1, 0.2, 0.3):
+        state.record_latency('1.2.3.4:2283', seconds)
+    assert state.deadline('1.2.3.4:2283', 5) == 1
+    for seconds in (2, 2, 2):
+        state.record_latency('1.2.3.4:2283', seconds)
+    assert state.deadline('1.2.3.4:2283', 5) == 6
+    state.save(conn)
+    assert HubState(conn).deadline('1.2.3.4:2283', 5) == 6
+
+def test_deadline_widens_for_a_slow_hub():
+    topology = Topology(2, degree=1, seed=1)
+    with HubSimulator(topology) as simulator:
+        address = simulator.address(1)
+        state = HubState()
+        for _ in range(LATENCY_SAMPLES):
+            state.record_latency(address, 0.05)
+        assert state.deadline(address, 5) == DEADLINE_FLOOR
+        # The hub slows down past its deadline: the call times out and the next deadline is wider.
+        topology.hubs[1].latency = 1.5
+        assert get_hubs._get_peers(address, state) is None
+        assert state.deadline(address, 5) == DEADLINE_FLOOR * DEADLINE_FACTOR
+        assert not state.is_open(address)
+        assert get_hubs._get_peers(address, state) is not None
@@ -0,0 +1,102 @@
+# SPDX-FileCopyrightText: 2024-present Panayotis Vryonis <vrypan@gmail.comm>
+#
+# SPDX-License-Identifier: MIT
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from fc_nmap import bench, db, ip2location
+from fc_nmap.cli import GEO_COLUMNS, update_hub_geo
+
+GEO_FIELDS = GEO_COLUMNS.values()
+
+class _Api(BaseHTTPRequestHandler):
+    def do_GET(self):
+        ip = parse_qs(urlparse(self.path).query)['ip'][0]
+        self.server.requests.append(ip)
+        body = json.dumps({'ip': ip, **{f: 'US' for f in GEO_FIELDS}}).encode()
+        self.send_response(200 if ip != '10.0.0.13' else 500)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def api(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Api)
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(ip2location, 'API_ENDPOINT', f'http://127.0.0.1:{server.server_port}/')
+    yield server
+    server.shutdown()
+
+def test_resolve_ips_quota(api, tmp_path):
+    conn = db.connect(str(tmp_path / 'hubs.db'))
+    quota = ip2location.DailyQuota(15, conn)
+    ips = [f'10.0.0.{i}' for i in range(20)]
+    results = dict(ip2location.resolve_ips('key', ips, workers=4, quota=quota))
+    assert len(results) == len(api.requests) == 15
+    assert sum(1 for info in results.values() if info) == 14 + ('10.0.0.13' not in results)
+    quota.save(conn)
+    # The count carries over to the next run on the same day.
+    quota = ip2location.DailyQuota(15, conn)
+    assert quota.remaining == 0
+    assert list(ip2location.resolve_ips('key', ips, quota=quota)) == []
+
+def test_resolve_ips_stops_early(api, monkeypatch):
+    monkeypatch.setattr(ip2location, '_session', None)
+    monkeypatch.setattr(ip2location, '_pool_size', 0)
+    ips = [f'10.0.0.{i}' for i in range(200)]
+    lookups = ip2location.resolve_ips('key', ips, workers=16, limiter=ip2location.RateLimiter(100))
+    next(lookups)
+    lookups.close()
+    # The lookups that had not started are dropped, and every worker has a pooled connection.
+    time.sleep(0.2)
+    assert len(api.requests) < 30
+    assert ip2location.session().get_adapter(ip2location.API_ENDPOINT)._pool_maxsize == 16
+
+def test_rate_limiter():
+    limiter = ip2location.RateLimiter(20, burst=5)
+    started = time.monotonic()
+    for _ in range(15):
+        limiter.acquire()
+    # 5 tokens up front, then 10 more at 20 per second.
+    assert 0.4 < time.monotonic() - started < 1
+
+def test_prefix():
+    assert ip2location.prefix('5.9.80.1') == '5.9.80.0/24'
+    assert ip2location.prefix('2a01:4f8:10a:1::2') == '2a01:4f8:10a::/48'
+    assert ip2location.prefix('5.9.80.1', v4=16) == '5.9.0.0/16'
+
+def test_update_hub_geo(api, tmp_path):
+    path = str(tmp_path / 'hubs.db')
+    # 300 hubs on 10.0.0.0/24 and 10.0.1.0/24; a second port on some IPs must not cost a lookup.
+    bench.populate_db(path, 300)
+    conn = db.connect(path)
+    conn.executemany("""INSERT INTO hub (addr_id, port, ts) VALUES (?, 2282, unixepoch())""", [(i,) for i in range(1, 51)])
+    conn.execute("""UPDATE addr SET updated_at = NULL""")
+    conn.commit()
+    previous = db.set_path(path)
+    try:
+        update_hub_geo('key', rate=10000)
+        assert len(api.requests) == 300
+        # 10.0.0.0/24 is located from its fresh rows; only one IP of 10.0.1.0/24 is looked up.
+        conn.execute("""UPDATE addr SET updated_at = unixepoch() - 1000 WHERE updated_at IS NOT NULL""")
+        conn.execute("""UPDATE addr SET updated_at = NULL, city_name = NULL WHERE addr_id > 250""")
+        conn.commit()
+        update_hub_geo('key', prefix_cache=(24, 48))
+    finally:
+        db.set_path(previous)
+    assert len(api.requests) == 301
+    assert conn.execute("""SELECT COUNT(*) FROM addr WHERE updated_at IS NOT NULL AND as_name = 'US'""").fetchone() == (300,)
+    # Neighbours get the country and ASN only; copied rows keep the age of their source.
+    assert conn.execute("""SELECT COUNT(*) FROM addr WHERE city_name IS NOT NULL AND addr_id > 250""").fetchone() == (1,)
+    assert conn.execute("""
+        SELECT COUNT(*) FROM addr WHERE addr_id BETWEEN 251 AND 256 AND updated_at < unixepoch() - 900
+        """).fetchone() == (6,)
@@ -0,0 +1,26 @@
+# SPDX-FileCopyrightText: 2024-present Panayotis Vryonis <vrypan@gmail.comm>
+#
+# SPDX-License-Identifier: MIT
+from click.testing import CliRunner
+
+from fc_nmap.cli import fc_nmap
+from fc_nmap.get_hubs import DiscoveryWindow
+from fc_nmap.simulator import HubSimulator, Topology
+
+def test_discovery_window():
+    window = DiscoveryWindow(size=3, min_rate=1)
+    window.add(10)
+    window.add(0)
+    assert not window.converged()
+    window.add(0)
+    assert not window.converged()
+    window.add(0)
+    assert window.converged()
+
+def test_default_bfs_scan_runs_to_the_frontier(tmp_path):
+    topology = Topology(120, degree=3, seed=5)
+    with HubSimulator(topology) as simulator:
+        result = CliRunner().invoke(fc_nmap, ['--db', str(tmp_path / 'hubs.db'), 'scan', '--hub', simulator.address(), '--mode', 'bfs', '--hops', '1000', '--timeout', '2'])
+    assert result.exit_code == 0, result.output
+    assert 'Stopped: frontier' in result.output
+    assert f'Hubs queried: {len(topology)},' in result.output
@@ -0,0 +1,116 @@
+# SPDX-FileCopyrightText: 2024-present Panayotis Vryonis <vrypan@gmail.comm>
+#
+# SPDX-License-Identifier: MIT
+import sqlite3
+
+from fc_nmap import schema
+
+# hub, hub_info, addr, scan_stats and the edge tables as they were before hub_id and epoch timestamps.
+OLD_SCHEMA = """
+CREATE TABLE hub(ip TEXT, port INTEGER, dnsname TEXT, proto_version TEXT, app_version TEXT, ts TEXT, PRIMARY KEY(ip,port));
+CREATE INDEX idx_hub_ip ON hub(ip);
+CREATE TABLE hub_info(ip TEXT, port INTEGER, version TEXT, is_syncing BOOL, nickname TEXT, root_hash TEXT, peerid TEXT, fid INTEGER,
+    num_messages INTEGER, num_fid_events INTEGER, num_fname_events INTEGER, approx_size INTEGER,
+    updated_at TEXT NOT NULL DEFAULT current_timestamp, PRIMARY KEY(ip,port));
+CREATE TABLE addr(ip text NOT NULL PRIMARY KEY, country_code TEXT, country_name TEXT, region_name TEXT, city_name TEXT,
+    latitude REAL, longitude REAL, zip_code TEXT, time_zone TEXT, as_number INTEGER, as_name TEXT, is_proxy BOOL,
+    updated_at TEXT NOT NULL DEFAULT current_timestamp);
+CREATE TABLE scan_stats(ts TEXT NOT NULL DEFAULT current_timestamp, hubs INTEGER DEFAULT 0);
+CREATE TABLE hub_key(id INTEGER PRIMARY KEY, address TEXT NOT NULL UNIQUE);
+CREATE TABLE edge(src INTEGER NOT NULL, dst INTEGER NOT NULL, ts INTEGER NOT NULL, PRIMARY KEY (src, dst)) WITHOUT ROWID;
+INSERT INTO hub VALUES ('1.2.3.4', 2283, 'hub.example.com', '2024.9.4', '1.15.6', '2024-10-01 00:00:00');
+INSERT INTO hub VALUES ('1.2.3.4', 2285, '', '2024.9.4', '1.15.6', '2024-10-01 00:00:00');
+INSERT INTO hub VALUES ('2001:db8::1', 2283, '', '2024.9.4', '1.15.5', '2024-10-01 00:00:00');
+INSERT INTO hub_info (ip, port, version, fid) VALUES ('1.2.3.4', 2285, '1.15.6', 42);
+INSERT INTO addr (ip, country_code) VALUES ('1.2.3.4', 'FI');
+INSERT INTO scan_stats VALUES ('2024-10-01 00:00:00', 3);
+INSERT INTO hub_key VALUES (1, '1.2.3.4:2283'), (2, '2001:db8::1:2283'), (3, 'hoyt.farcaster.xyz:2283');
+INSERT INTO edge VALUES (1, 2, 100), (3, 1, 100);
+"""
+
+def test_pack_ip():
+    assert len(schema.pack_ip('1.2.3.4')) == 4
+    assert len(schema.pack_ip('[2001:db8::1]')) == 16
+    assert schema.pack_ip('hoyt.farcaster.xyz') is None
+    assert schema.unpack_ip(schema.pack_ip('2001:db8::1')) == '2001:db8::1'
+
+def test_migrate_to_hub_ids():
+    conn = sqlite3.connect(':memory:')
+    conn.executescript(OLD_SCHEMA)
+    schema.create_schema(conn)
+    hubs = {
+        (schema.unpack_ip(ip), port): (hub_id, country, fid)
+        for hub_id, ip, port, country, fid in conn.execute("""
+            SELECT hub.hub_id, addr.ip, hub.port, addr.country_code, hub_info.fid FROM hub
+            JOIN addr ON addr.addr_id = hub.addr_id
+            LEFT JOIN hub_info ON hub_info.hub_id = hub.hub_id
+            """)
+    }
+    assert {k: v[1:] for k, v in hubs.items()} == {
+        ('1.2.3.4', 2283): ('FI', None),
+        ('1.2.3.4', 2285): ('FI', 42),
+        ('2001:db8::1', 2283): (None, None),
+    }
+    # The edge from the hub known by hostname has no hub_id to point to.
+    assert conn.execute("""SELECT src, dst FROM edge""").fetchall() == [(hubs[('1.2.3.4', 2283)][0], hubs[('2001:db8::1', 2283)][0])]
+    assert 'hub_key' not in {r[0] for r in conn.execute("""SELECT name FROM sqlite_master""")}
+    assert conn.execute("""SELECT DISTINCT ts FROM hub""").fetchall() == [(1727740800,)]
+    assert conn.execute("""SELECT ts, hubs FROM scan_stats""").fetchall() == [(1727740800, 3)]
+    # Running it again is a no-op.
+    schema.create_schema(conn)
+    assert conn.execute("""SELECT COUNT(*) FROM hub""").fetchone() == (3,)
+
+def test_freshness_filters_use_indexes():
+    conn = sqlite3.connect(':memory:')
+    schema.create_schema(conn)
+    for table, column in schema.EPOCH_COLUMNS[:3]:
+        plan = conn.execute(f"""EXPLAIN QUERY PLAN SELECT * FROM {table} WHERE {column} > unixepoch() - ?""", (86400,)).fetchall()
+        assert f'USING INDEX idx_{table}_{column}' in plan[0][3]
+
+def test_new_database_is_current():
+    conn = sqlite3.connect(':memory:')
+    schema.create_schema(conn)
+    assert schema.schema_version(conn) == schema.SCHEMA_VERSION
+    assert schema.pending_migrations(conn) == []
+
+def test_dry_run_rolls_back():
+    conn = sqlite3.connect(':memory:')
+    conn.executescript(OLD_SCHEMA)
+    results = schema.migrate(conn, dry_run=True, explain=True)
+    assert [r[0] for r in results] == [1, 2, 3, 4]
+    statements = [sql for r in results for sql, _, _ in r[3]]
+    assert any(sql.startswith('INSERT OR IGNORE INTO hub ') for sql in statements)
+    assert schema.schema_version(conn) is None
+    assert 'ip' in [r[1] for r in conn.execute('PRAGMA table_info(hub)')]
+    assert conn.execute("""SELECT COUNT(*) FROM hub""").fetchone() == (3,)
+    schema.create_schema(conn)
+    assert schema.schema_version(conn) == schema.SCHEMA_VERSION
+
+def test_migrate_rpc_log_to_hub_ids():
+    conn = sqlite3.connect(':memory:')
+    schema.create_schema(conn)
+    conn.executescript("""
+        DROP TABLE rpc_log;
+        CREATE TABLE rpc_log(ts INTEGER NOT NULL, address TEXT NOT NULL, method TEXT NOT NULL, tls BOOL NOT NULL,
+            status TEXT NOT NULL, ms INTEGER NOT NULL, size INTEGER);
+        CREATE INDEX idx_rpc_log_ts ON rpc_log(ts);
+        INSERT INTO rpc_log VALUES (100, '1.2.3.4:2283', 'GetInfo', 1, 'OK', 20, 300);
+        INSERT INTO rpc_log VALUES (101, '[2001:db8::1]:2283', 'GetCurrentPeers', 0, 'DEADLINE_EXCEEDED', 5000, NULL);
+        INSERT INTO rpc_log VALUES (102, 'hoyt.farcaster.xyz:2283', 'GetCurrentPeers', 1, 'OK', 80, 9000);
+        UPDATE kv SET v = 3 WHERE k = 'SCHEMA_VERSION';
+        """)
+    schema.create_schema(conn)
+    rows = conn.execute("""
+        SELECT rpc_log.ts, addr.ip, hub.port, method, tls, status, ms, size FROM rpc_log
+        JOIN hub ON hub.hub_id = rpc_log.hub_id
+        JOIN addr ON addr.addr_id = hub.addr_id
+        ORDER BY rpc_log.ts
+        """).fetchall()
+    # The call to the hub known by hostname has no hub_id and is dropped.
+    assert [(ts, schema.unpack_ip(ip), *rest) for ts, ip, *rest in rows] == [
+        (100, '1.2.3.4', 2283, schema.RPC_METHODS['GetInfo'], 1, 0, 20, 300),
+        (101, '2001:db8::1', 2283, schema.RPC_METHODS['GetCurrentPeers'], 0, 4, 5000, None),
+    ]
+    plan = conn.execute("""EXPLAIN QUERY PLAN SELECT * FROM rpc_log WHERE ts > ?""", (0,)).fetchall()
+    assert 'USING INDEX idx_rpc_log_ts' in plan[0][3]
+    assert schema.schema_version(conn) == schema.SCHEMA_VERSION
@@ -0,0 +1,127 @@
+# SPDX-FileCopyrightText: 2024-present Panayotis Vryonis <vrypan@gmail.comm>
+#
+# SPDX-License-Identifier: MIT
+import asyncio
+import functools
+import socket
+import time
+
+import pytest
+from grpc import StatusCode
+
+from fc_nmap import get_hubs, hubstate
+from fc_nmap.GrpcClient import ChannelPool
+from fc_nmap.hubstate import HubState
+from fc_nmap.simulator import HubSimulator, Topology
+
+@pytest.fixture(scope='module')
+def simulator():
+    with HubSimulator(Topology(30, degree=4, tls_only=0.2, dead=0.1, seed=1)) as simulator:
+        yield simulator
+
+def _reachable(topology):
+    return {f'127.0.0.1:{h.port}' for h in topology.hubs if not h.dead}
+
+def test_bfs_finds_every_hub(simulator):
+    stats = {}
+    hubs = get_hubs.get_hubs_bfs(simulator.address(), {}, 1000, stats=stats, timeout=2)
+    assert set(hubs) >= _reachable(simulator.topology) - {simulator.address()}
+    assert stats['stop_reason'] == 'frontier'
+
+def test_bfs_queries_every_hub_once(simulator, monkeypatch):
+    calls = []
+    get_peers = get_hubs._get_peers
+    def counting_get_peers(address, *args):
+        calls.append(address)
+        return get_peers(address, *args)
+    monkeypatch.setattr(get_hubs, '_get_peers', counting_get_peers)
+    # A hub whose circuit is open is skipped, not queried.
+    state = HubState()
+    open_hub = simulator.address(next(h.index for h in simulator.topology.hubs[1:] if not h.dead))
+    for _ in range(hubstate.FAILURE_THRESHOLD):
+        state.record_failure(open_hub)
+    stats = {}
+    get_hubs.get_hubs_bfs(simulator.address(), {}, 1000, stats=stats, state=state, timeout=2)
+    assert len(calls) == len(set(calls)) == len(simulator.topology) - 1
+    assert open_hub not in calls
+    assert stats['queried'] == len(calls)
+    assert stats['skipped'] == 1
+    assert stats['unreachable'] == sum(1 for h in simulator.topology.hubs if h.dead)
+
+def test_concurrent_bfs(simulator):
+    hubs = asyncio.run(get_hubs.get_hubs_concurrent(simulator.address(), {}, 1000, concurrency=8, timeout=2, mode='bfs'))
+    assert set(hubs) >= _reachable(simulator.topology) - {simulator.address()}
+
+def test_concurrent_scan_survives_failing_hubs(simulator, monkeypatch):
+    # One hub's call is cancelled, as when its channel is closed mid-call; dead hubs fail with UNAVAILABLE.
+    cancelled = simulator.address(next(h.index for h in simulator.topology.hubs[1:] if not h.dead))
+    get_peers = get_hubs._get_peers_async
+    async def get_peers_async(address, *args):
+        if address == cancelled:
+            raise asyncio.CancelledError()
+        return await get_peers(address, *args)
+    monkeypatch.setattr(get_hubs, '_get_peers_async', get_peers_async)
+    stats = {}
+    hubs = asyncio.run(get_hubs.get_hubs_concurrent(simulator.address(), {}, 1000, concurrency=8, timeout=2, mode='bfs', stats=stats))
+    assert set(hubs) >= _reachable(simulator.topology) - {simulator.address()}
+    dead = sum(1 for h in simulator.topology.hubs if h.dead)
+    assert stats['unreachable'] == dead + 1
+    assert stats['queried'] == len(simulator.topology)
+    assert stats['stop_reason'] == 'frontier'
+
+def test_concurrent_scan_with_more_hubs_than_the_pool(monkeypatch):
+    # Hanging hubs keep their channels busy while the pool is full; no call may be cut short.
+    monkeypatch.setattr(get_hubs, 'ChannelPool', functools.partial(ChannelPool, max_size=4))
+    with HubSimulator(Topology(60, degree=4, timeouts=0.1, seed=11)) as simulator:
+        state = HubState()
+        stats = {}
+        asyncio.run(get_hubs.get_hubs_concurrent(simulator.address(), {}, 1000, concurrency=16, timeout=2, mode='bfs', stats=stats, state=state))
+    hanging = [h for h in simulator.topology.hubs if h.hangs]
+    assert hanging
+    assert stats['queried'] == len(simulator.topology)
+    assert stats['unreachable'] >= len(hanging)
+    assert {entry[1] for entry in state._failures.values()} == {'DEADLINE_EXCEEDED'}
+
+def test_tls_only_hub(simulator):
+    hub = next(h for h in simulator.topology.hubs if h.tls_only and not h.dead)
+    state = HubState()
+    info = get_hubs.get_hub_info('127.0.0.1', hub.port, 'localhost', timeout=2, state=state, allow_private=True)
+    assert info.nickname == f'sim-{hub.index}'
+    assert state.transport(f'127.0.0.1:{hub.port}') is True
+
+def test_dead_hub(simulator):
+    hub = next(h for h in simulator.topology.hubs if h.dead)
+    assert get_hubs.get_hub_info('127.0.0.1', hub.port, '', timeout=2, allow_private=True) is None
+
+def _rpc_log(state):
+    """{(tls, status)} of the logged calls, once the callbacks of cancelled calls have run."""
+    time.sleep(0.2)
+    return {(entry[3], entry[4]) for entry in state._rpc_log}
+
+def test_race_tls_wins(simulator):
+    # Plaintext on a TLS-only port fails at once, so TLS starts without waiting for the stagger.
+    hub = next(h for h in simulator.topology.hubs if h.tls_only and not h.dead)
+    state = HubState()
+    started = time.monotonic()
+    info = get_hubs.get_hub_info('127.0.0.1', hub.port, 'localhost', timeout=2, state=state, race=True, allow_private=True)
+    assert info.nickname == f'sim-{hub.index}'
+    assert time.monotonic() - started < get_hubs.RACE_STAGGER
+    assert _rpc_log(state) == {(False, StatusCode.UNAVAILABLE.value[0]), (True, StatusCode.OK.value[0])}
+    assert state.transport(f'127.0.0.1:{hub.port}') is True
+    assert state.transport(f'localhost:{hub.port}') is True
+
+def test_race_cancels_the_loser(simulator):
+    # A plaintext "hub" that accepts connections and never answers, on the TLS hub's port.
+    hub = next(h for h in simulator.topology.hubs if h.tls_only and not h.dead)
+    with socket.socket() as silent:
+        silent.bind(('127.0.0.2', hub.port))
+        silent.listen()
+        state = HubState()
+        started = time.monotonic()
+        info = get_hubs.get_hub_info('127.0.0.2', hub.port, 'localhost', timeout=5, state=state, race=True, allow_private=True)
+        elapsed = time.monotonic() - started
+        assert info.nickname == f'sim-{hub.index}'
+        # TLS started after the stagger and won long before the plaintext deadline.
+        assert get_hubs.RACE_STAGGER <= elapsed < 2
+        assert _rpc_log(state) == {(False, StatusCode.CANCELLED.value[0]), (True, StatusCode.OK.value[0])}
+        assert state.transport(f'127.0.0.2:{hub.port}') is True
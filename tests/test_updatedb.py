@@ -0,0 +1,93 @@
+# SPDX-FileCopyrightText: 2024-present Panayotis Vryonis <vrypan@gmail.comm>
+#
+# SPDX-License-Identifier: MIT
+import signal
+import subprocess
+import sys
+import time
+
+from grpc import StatusCode
+
+from fc_nmap import GrpcClient, db
+from fc_nmap.cli import update_hub_info
+from fc_nmap.schema import intern_hubs
+from fc_nmap.simulator import HubSimulator, Topology
+
+def _scanned(path, simulator, hubs):
+    """A hubs.db where `hubs` of the simulator were just seen by a scan, in that order."""
+    conn = db.connect(path)
+    ids = intern_hubs(conn, [f'{simulator.host}:{h.port}' for h in hubs])
+    conn.executemany("""UPDATE hub SET dnsname = '', ts = unixepoch() WHERE hub_id = ?""", [(i,) for i in ids.values()])
+    conn.execute("""INSERT OR REPLACE INTO kv VALUES ('LAST_SCAN', unixepoch('now'))""")
+    conn.commit()
+    return conn
+
+def test_update_hub_info_workers(tmp_path, monkeypatch):
+    writers = []
+    class Writer(db.DbWriter):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            writers.append(self)
+    monkeypatch.setattr(db, 'DbWriter', Writer)
+    path = str(tmp_path / 'hubs.db')
+    with HubSimulator(Topology(40, degree=2, dead=0.2, seed=3)) as simulator:
+        conn = _scanned(path, simulator, simulator.topology.hubs)
+        update_hub_info(None, 86400, 2, workers=8, batch_size=5, batch_seconds=60, allow_private=True, dbpath=path)
+    alive = simulator.topology.alive()
+    assert conn.execute("""SELECT COUNT(*) FROM hub_info""").fetchone() == (40,)
+    assert {r[0] for r in conn.execute("""SELECT nickname FROM hub_info WHERE nickname IS NOT NULL""")} == {f'sim-{h.index}' for h in alive}
+    # 40 rows in batches of 5, plus the HubState save.
+    assert writers[0].rows == 40
+    assert writers[0].commits >= 8
+    assert conn.execute("""SELECT COUNT(*) FROM rpc_log""").fetchone()[0] >= 40
+
+def test_update_hub_info_with_more_hubs_than_the_pool(tmp_path, monkeypatch):
+    monkeypatch.setattr(GrpcClient, 'channel_pool', GrpcClient.ChannelPool(max_size=4))
+    path = str(tmp_path / 'hubs.db')
+    with HubSimulator(Topology(60, degree=2, timeouts=0.1, seed=11)) as simulator:
+        conn = _scanned(path, simulator, simulator.topology.hubs)
+        update_hub_info(None, 86400, 2, workers=16, allow_private=True, dbpath=path)
+    hanging = sum(1 for h in simulator.topology.hubs if h.hangs)
+    assert hanging
+    # Hanging hubs time out; no call on a busy channel is cancelled by the pool.
+    statuses = dict(conn.execute("""SELECT status, COUNT(*) FROM rpc_log GROUP BY status"""))
+    assert set(statuses) == {StatusCode.OK.value[0], StatusCode.DEADLINE_EXCEEDED.value[0]}
+    assert statuses[StatusCode.DEADLINE_EXCEEDED.value[0]] >= hanging
+    assert sum(statuses.values()) == len(simulator.topology)
+
+def test_interrupted_update_keeps_committed_rows(tmp_path):
+    path = str(tmp_path / 'hubs.db')
+    topology = Topology(40, degree=2, seed=3)
+    healthy = topology.hubs[:4]
+    for hub in topology.hubs[4:]:
+        hub.hangs = True
+    with HubSimulator(topology) as simulator:
+        conn = _scanned(path, simulator, topology.hubs)
+        process = subprocess.Popen(
+            [sys.executable, '-c', 'from fc_nmap.cli import fc_nmap; fc_nmap()', '--db', path,
+            'updatedb', '--hub-info', '--allow-private', '--workers', '2', '--timeout', '3', '--batch-seconds', '60'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        time.sleep(2.5)
+        interrupted = time.monotonic()
+        process.send_signal(signal.SIGINT)
+        process.wait(timeout=30)
+        # Only the two probes in flight are waited for, not the 36 queued hanging hubs.
+        assert time.monotonic() - interrupted < 5
+    # The healthy hubs answered first; their rows were still in the writer's batch and were committed on exit.
+    assert {r[0] for r in conn.execute("""SELECT nickname FROM hub_info""")} == {f'sim-{h.index}' for h in healthy}
+    assert conn.execute("""SELECT COUNT(*) FROM rpc_log WHERE status = 0""").fetchone() == (len(healthy),)
+    # The two probes in flight timed out before the hub state was saved.
+    assert conn.execute("""SELECT COUNT(*) FROM rpc_log WHERE status = ?""", (StatusCode.DEADLINE_EXCEEDED.value[0],)).fetchone() == (2,)
+    assert conn.execute("""SELECT COUNT(*) FROM hub_failure""").fetchone() == (2,)
+
+def test_failed_probe_keeps_hub_info(tmp_path):
+    path = str(tmp_path / 'hubs.db')
+    topology = Topology(3, degree=1, seed=3)
+    topology.hubs[1].dead = True
+    with HubSimulator(topology) as simulator:
+        conn = _scanned(path, simulator, topology.hubs)
+        conn.execute("""INSERT INTO hub_info (hub_id, version, nickname, fid, updated_at) SELECT hub_id, '1.15.0', 'known', 7, 0 FROM hub""")
+        conn.commit()
+        update_hub_info(None, 86400, 2, allow_private=True, dbpath=path)
+    rows = conn.execute("""SELECT nickname, fid, updated_at > 0 FROM hub_info ORDER BY hub_id""").fetchall()
+    assert rows == [('sim-0', 0, 1), ('known', 7, 1), ('sim-2', 2, 1)]